@@ -101,6 +101,23 @@ doctype_js = {
 #	}
 # }
 
+doc_events = {
+	"Voice Call Settings": {
+		"on_update": [
+			"twilio_integration.twilio_integration.twilio_handler.clear_number_owners_cache",
+			"twilio_integration.twilio_integration.twilio_handler.clear_voice_access_token"
+		],
+		"on_trash": [
+			"twilio_integration.twilio_integration.twilio_handler.clear_number_owners_cache",
+			"twilio_integration.twilio_integration.twilio_handler.clear_voice_access_token"
+		]
+	},
+	"User": {
+		"on_update": "twilio_integration.twilio_integration.twilio_handler.clear_number_owners_cache",
+		"on_trash": "twilio_integration.twilio_integration.twilio_handler.clear_number_owners_cache"
+	}
+}
+
 # Scheduled Tasks
 # ---------------
 
@@ -122,6 +139,26 @@ doctype_js = {
 # 	]
 # }
 
+scheduler_events = {
+	"hourly_long": [
+		"twilio_integration.twilio_integration.doctype.twilio_phone_number.twilio_phone_number.sync_phone_numbers"
+	],
+	"cron": {
+		"* * * * *": [
+			"twilio_integration.twilio_integration.doctype.whatsapp_message.whatsapp_message.flush_status_callbacks",
+			"twilio_integration.twilio_integration.doctype.whatsapp_message.whatsapp_message.flush_incoming_messages",
+			"twilio_integration.twilio_integration.doctype.whatsapp_message.whatsapp_message.retry_whatsapp_messages",
+			"twilio_integration.twilio_integration.doctype.whatsapp_campaign.whatsapp_campaign.send_scheduled_campaigns"
+		],
+		"*/5 * * * *": [
+			"twilio_integration.twilio_integration.doctype.whatsapp_campaign.whatsapp_campaign.resume_stalled_campaigns",
+			"twilio_integration.twilio_integration.twilio_handler.sync_online_agents",
+			"twilio_integration.twilio_integration.api.flush_pending_call_logs",
+			"twilio_integration.twilio_integration.api.reconcile_call_logs"
+		]
+	}
+}
+
 # Testing
 # -------
 
@@ -152,3 +189,8 @@ override_doctype_class = {
 # boot
 # ----------
 boot_session = "twilio_integration.boot.boot_session"
+
+# session
+# ----------
+on_session_creation = "twilio_integration.twilio_integration.twilio_handler.set_agent_online"
+on_logout = "twilio_integration.twilio_integration.twilio_handler.set_agent_offline"
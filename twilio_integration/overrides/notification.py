@@ -3,6 +3,7 @@ import re
 from frappe import _
 from frappe.email.doctype.notification.notification import Notification, get_context, json
 from twilio_integration.twilio_integration.doctype.whatsapp_message.whatsapp_message import WhatsAppMessage
+from twilio_integration.twilio_integration.doctype.whatsapp_message_template.whatsapp_message_template import get_compiled_template
 
 class SendNotification(Notification):
 	def validate(self):
@@ -19,7 +20,7 @@ class SendNotification(Notification):
 				frappe.throw(_("Please select a WhatsApp template when template mode is enabled"))
 			
 			# Check if template is approved
-			template_doc = frappe.get_doc("WhatsApp Message Template", self.whatsapp_template)
+			template_doc = get_compiled_template(self.whatsapp_template)
 			if template_doc.template_status != "Approved":
 				frappe.throw(_("Selected WhatsApp template must be approved before use"))
 
@@ -48,23 +49,29 @@ class SendNotification(Notification):
 		
 		if self.use_whatsapp_template and self.whatsapp_template:
 			# Template mode - extract variables and prepare template info
-			template_doc = frappe.get_doc("WhatsApp Message Template", self.whatsapp_template)
+			template_doc = get_compiled_template(self.whatsapp_template)
 			
 			if template_doc.content_sid:
-				# Extract variables from rendered message
-				variable_values = self.extract_template_variables(rendered_message, template_doc)
+				if template_doc.source_fields:
+					# Bind variables from the fields mapped on the template
+					rendered_message, content_variables = template_doc.bind_rows([doc])[0]
+				else:
+					# Extract variables from rendered message
+					variable_values = self.extract_template_variables(rendered_message, template_doc)
+					content_variables = template_doc.get_content_variables(variable_values)
 				
 				template_info = {
 					'template_name': self.whatsapp_template,
 					'content_sid': template_doc.content_sid,
-					'content_variables': template_doc.get_content_variables(variable_values)
+					'content_variables': content_variables
 				}
 			else:
 				frappe.throw(_("Template {0} does not have a Content SID").format(self.whatsapp_template))
 		else:
 			# Check if recipients are within session window for freeform messages
+			in_session = WhatsAppMessage.get_session_window_status([f"whatsapp:{receiver}" for receiver in receiver_list])
 			for receiver in receiver_list:
-				if not WhatsAppMessage.is_in_session_window(f"whatsapp:{receiver}"):
+				if not in_session[f"whatsapp:{receiver}"]:
 					frappe.msgprint(
 						_("Recipient {0} is outside 24-hour window. Consider using WhatsApp Template mode.").format(receiver),
 						indicator="orange"
@@ -0,0 +1,7 @@
+import frappe
+
+def execute():
+	"""Index campaigns by status and scheduled time for the scheduler's due campaign query.
+	"""
+	frappe.reload_doc('twilio_integration', 'doctype', 'whatsapp_campaign')
+	frappe.db.add_index('WhatsApp Campaign', ['status', 'scheduled_time'], 'status_scheduled_time_index')
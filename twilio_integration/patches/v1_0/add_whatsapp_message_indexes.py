@@ -0,0 +1,8 @@
+import frappe
+
+def execute():
+	"""Index the columns used by status callbacks and the 24-hour session window check.
+	Single column indexes come from `search_index` in the doctype, the composite one is added here.
+	"""
+	frappe.reload_doc('twilio_integration', 'doctype', 'whatsapp_message')
+	frappe.db.add_index('WhatsApp Message', ['from_', 'sent_received', 'send_on'], 'from_sent_received_send_on_index')
@@ -0,0 +1,15 @@
+import frappe
+
+def execute():
+	"""Drop repeated deliveries of the same Twilio message before `id` becomes unique.
+	The first stored row of every MessageSid is kept.
+	"""
+	frappe.db.sql("UPDATE `tabWhatsApp Message` SET `id` = NULL WHERE `id` = ''")
+	frappe.db.sql("""
+		DELETE duplicate FROM `tabWhatsApp Message` duplicate
+		JOIN `tabWhatsApp Message` original
+			ON original.`id` = duplicate.`id`
+			AND (original.`creation` < duplicate.`creation`
+				OR (original.`creation` = duplicate.`creation` AND original.`name` < duplicate.`name`))
+	""")
+	frappe.reload_doc('twilio_integration', 'doctype', 'whatsapp_message')
@@ -19,6 +19,7 @@ var onload_script = function() {
 					fakeLocalDTMF: true,
 					enableRingingState: true,
 				});
+				schedule_token_refresh(data.message.refresh_in);
 
 				device.on("ready", function (device) {
 					Object.values(frappe.twilio_conn_dialog_map).forEach(function(popup){
@@ -88,6 +89,29 @@ var onload_script = function() {
 		});
 	}
 
+	function schedule_token_refresh(refresh_in) {
+		if (refresh_in == null) return;
+		// Jitter keeps open tabs of agents that logged in together from refreshing at once
+		const jitter = Math.random() * 30;
+		setTimeout(refresh_token, (refresh_in + jitter) * 1000);
+	}
+
+	function refresh_token() {
+		frappe.call({
+			method: "twilio_integration.twilio_integration.api.generate_access_token",
+			callback: (data) => {
+				if (!data.message.token) return;
+				if (device.updateToken) {
+					device.updateToken(data.message.token);
+				} else {
+					device.setup(data.message.token);
+				}
+				schedule_token_refresh(data.message.refresh_in);
+			},
+			error: () => schedule_token_refresh(60)
+		});
+	}
+
 	function dialer_screen() {
 		frappe.phone_call.handler = (to_number, frm) => {
 			let to_numbers;
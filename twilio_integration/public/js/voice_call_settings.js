@@ -8,6 +8,9 @@ frappe.ui.form.on('Voice Call Settings', {
 	refresh: function(frm) {
 		frappe.call({
 			method: "twilio_integration.twilio_integration.api.get_twilio_phone_numbers",
+			args: {
+				capability: 'Voice'
+			},
 			callback: function(resp) {
 				if (resp.message.length) {
 					frm.set_df_property('twilio_number', 'options', resp.message);
@@ -2,36 +2,60 @@ from werkzeug.wrappers import Response
 
 import frappe
 from frappe import _
+from frappe.utils import cint, now_datetime, add_to_date
 from frappe.contacts.doctype.contact.contact import get_contact_with_phone_number
-from .twilio_handler import Twilio, IncomingCall, TwilioCallDetails
-from twilio_integration.twilio_integration.doctype.whatsapp_message.whatsapp_message import incoming_message_callback
+from .twilio_handler import Twilio, IncomingCall, TwilioCallDetails, get_voice_access_token
+from .call_routing import set_call_ended, set_dialled_call_ended
+from .utils import bulk_update, is_first_delivery, forget_delivery
+from .twiml import get_twiml_template
+from twilio_integration.twilio_integration.doctype.whatsapp_message.whatsapp_message import buffer_incoming_message, \
+	process_status_callback, buffer_status_callback, park_unmatched_status_callbacks, get_status_callback_buffer_metrics
+from twilio_integration.twilio_integration.doctype.whatsapp_message_template.whatsapp_message_template import get_compiled_template
+from twilio_integration.twilio_integration.doctype.twilio_phone_number.twilio_phone_number import get_phone_numbers, \
+	enqueue_phone_number_sync
 from twilio.twiml.messaging_response import MessagingResponse
 
+PENDING_CALL_LOGS = 'twilio_pending_call_logs'
+FINAL_CALL_STATUSES = ('Completed', 'Busy', 'Failed', 'No Answer', 'Canceled')
+RECONCILE_AFTER_MINUTES = 10
+RECONCILE_BATCH_SIZE = 100
+
 @frappe.whitelist()
-def get_twilio_phone_numbers():
+def get_twilio_phone_numbers(capability=None):
+	"""Account's Twilio numbers from the local inventory, optionally only those with a capability (Voice, SMS or WhatsApp).
+	"""
 	twilio = Twilio.connect()
-	return (twilio and twilio.get_phone_numbers()) or []
+	if not twilio:
+		return []
+
+	numbers = get_phone_numbers(capability)
+	if not (numbers or frappe.db.count('Twilio Phone Number')):
+		# Inventory has never been synced
+		enqueue_phone_number_sync()
+		return twilio.get_phone_numbers(capability)
+	return numbers
+
+@frappe.whitelist()
+def sync_twilio_phone_numbers():
+	frappe.only_for('System Manager')
+	enqueue_phone_number_sync()
 
 @frappe.whitelist()
 def generate_access_token():
-	"""Returns access token that is required to authenticate Twilio Client SDK.
+	"""Returns access token that is required to authenticate Twilio Client SDK,
+	along with the seconds after which the client should ask for a fresh one.
 	"""
-	twilio = Twilio.connect()
-	if not twilio:
+	if not frappe.get_cached_doc('Twilio Settings').enabled:
 		return {}
 
-	from_number = frappe.db.get_value('Voice Call Settings', frappe.session.user, 'twilio_number')
-	if not from_number:
+	token = get_voice_access_token(frappe.session.user)
+	if not token:
 		return {
 			"ok": False,
 			"error": "caller_phone_identity_missing",
 			"detail": "Phone number is not mapped to the caller"
 		}
-
-	token=twilio.generate_voice_access_token(from_number=from_number, identity=frappe.session.user)
-	return {
-		'token': frappe.safe_decode(token)
-	}
+	return token
 
 @frappe.whitelist(allow_guest=True)
 def voice(**kwargs):
@@ -55,55 +79,164 @@ def voice(**kwargs):
 	resp = twilio.generate_twilio_dial_response(from_number, args.To)
 
 	call_details = TwilioCallDetails(args, call_from=from_number)
-	create_call_log(call_details)
+	enqueue_call_log_once(call_details)
 	return Response(resp.to_xml(), mimetype='text/xml')
 
 @frappe.whitelist(allow_guest=True)
 def twilio_incoming_call_handler(**kwargs):
 	args = frappe._dict(kwargs)
 	call_details = TwilioCallDetails(args)
-	create_call_log(call_details)
+	enqueue_call_log_once(call_details)
 
 	resp = IncomingCall(args.From, args.To).process()
 	return Response(resp.to_xml(), mimetype='text/xml')
 
-@frappe.whitelist()
-def create_call_log(call_details: TwilioCallDetails):
-	call_log = frappe.get_doc({**call_details.to_dict(),
-		'doctype': 'Call Log',
-		'medium': 'Twilio'
-	})
-
-	call_log.flags.ignore_permissions = True
-	call_log.save()
+def enqueue_call_log_once(call_details: TwilioCallDetails):
+	"""Queue the call log on the first delivery of the call's webhook, redeliveries only get TwiML back.
+	"""
+	if not is_first_delivery('call', call_details.call_sid):
+		return
+
+	try:
+		enqueue_call_log(call_details)
+	except Exception:
+		forget_delivery('call', call_details.call_sid)
+		raise
+
+def enqueue_call_log(call_details: TwilioCallDetails):
+	"""Write the call log in the background, so that webhooks return TwiML without waiting for the insert.
+	The log is also kept in a pending hash until it is inserted, `flush_pending_call_logs` writes
+	the ones whose job was lost.
+	"""
+	call_log = call_details.to_dict()
+	try:
+		frappe.cache().hset(PENDING_CALL_LOGS, call_log['id'], call_log)
+		frappe.enqueue(
+			'twilio_integration.twilio_integration.api.insert_call_log',
+			queue='short',
+			call_log=call_log
+		)
+	except Exception:
+		# Redis is unreachable, write the log in the request instead of losing it
+		insert_call_log(call_log)
+
+def insert_call_log(call_log):
+	"""Insert a call log once, repeated deliveries of the same call are ignored.
+	"""
+	if not frappe.db.exists('Call Log', call_log['id']):
+		doc = frappe.get_doc({**call_log,
+			'doctype': 'Call Log',
+			'medium': 'Twilio'
+		})
+		doc.flags.ignore_permissions = True
+		try:
+			doc.insert()
+		except frappe.DuplicateEntryError:
+			frappe.db.rollback()
+	frappe.db.commit()
+	try:
+		frappe.cache().hdel(PENDING_CALL_LOGS, call_log['id'])
+	except Exception:
+		pass
+
+def flush_pending_call_logs():
+	"""Insert call logs that are still pending, the job queued for them has failed or been lost.
+	"""
+	for call_log in (frappe.cache().hgetall(PENDING_CALL_LOGS) or {}).values():
+		try:
+			insert_call_log(call_log)
+		except Exception:
+			frappe.db.rollback()
+			frappe.log_error(title=_("Failed to create Twilio call log"))
+
+def write_call_log(call_sid, values):
+	"""Update the call log in a single statement and commit.
+	A log whose queued insert has not run yet is inserted from the pending hash first.
+	"""
+	if not frappe.db.exists("Call Log", call_sid):
+		call_log = frappe.cache().hget(PENDING_CALL_LOGS, call_sid)
+		if not call_log: return
+		# Skipped if the queued insert got there first, the values are applied below either way
+		insert_call_log(call_log)
+	frappe.db.set_value("Call Log", call_sid, values)
 	frappe.db.commit()
 
 @frappe.whitelist()
 def update_call_log(call_sid, status=None):
 	"""Update call log status.
+	Duration comes later from the status and recording callbacks, or `reconcile_call_logs`.
 	"""
-	twilio = Twilio.connect()
-	if not (twilio and frappe.db.exists("Call Log", call_sid)): return
-
-	call_details = twilio.get_call_info(call_sid)
-	call_log = frappe.get_doc("Call Log", call_sid)
-	call_log.status = status or TwilioCallDetails.get_call_status(call_details.status)
-	call_log.duration = call_details.duration
-	call_log.flags.ignore_permissions = True
-	call_log.save()
-	frappe.db.commit()
+	if status:
+		write_call_log(call_sid, {'status': status})
+
+	# Calls are hung up from the attender's browser
+	if frappe.session.user != 'Guest':
+		set_call_ended(frappe.session.user)
+
+@frappe.whitelist(allow_guest=True)
+def call_status_callback(**kwargs):
+	"""This is a webhook called by Twilio when a dialled call leg is completed.
+	"""
+	try:
+		args = frappe._dict(kwargs)
+		# Attenders taking calls on their phone do not hang up through `update_call_log`
+		set_dialled_call_ended(args.To)
+		write_call_log(args.ParentCallSid or args.CallSid, {
+			'status': TwilioCallDetails.get_call_status(args.CallStatus),
+			'duration': cint(args.CallDuration)
+		})
+	except Exception:
+		frappe.log_error(title=_("Failed to update Twilio call status"))
 
 @frappe.whitelist(allow_guest=True)
 def update_recording_info(**kwargs):
 	try:
 		args = frappe._dict(kwargs)
-		recording_url = args.RecordingUrl
-		call_sid = args.CallSid
-		update_call_log(call_sid)
-		frappe.db.set_value("Call Log", call_sid, "recording_url", recording_url)
+		# Recordings are only reported once the dialled call has completed
+		write_call_log(args.CallSid, {
+			'status': 'Completed',
+			'duration': cint(args.RecordingDuration),
+			'recording_url': args.RecordingUrl
+		})
 	except:
 		frappe.log_error(title=_("Failed to capture Twilio recording"))
 
+def reconcile_call_logs():
+	"""Fetch status and duration from Twilio for recent call logs that no callback has completed.
+	"""
+	twilio = Twilio.connect()
+	if not twilio: return
+
+	now = now_datetime()
+	call_sids = frappe.db.sql_list("""
+		SELECT `name` FROM `tabCall Log`
+		WHERE `medium` = 'Twilio'
+			AND `creation` BETWEEN %(since)s AND %(until)s
+			AND (`status` NOT IN %(final_statuses)s OR `duration` IS NULL)
+		ORDER BY `creation`
+		LIMIT %(limit)s
+		""", {
+			'since': add_to_date(now, days=-1),
+			'until': add_to_date(now, minutes=-RECONCILE_AFTER_MINUTES),
+			'final_statuses': FINAL_CALL_STATUSES,
+			'limit': RECONCILE_BATCH_SIZE
+		})
+
+	updates = {}
+	for call_sid in call_sids:
+		try:
+			call_details = twilio.get_call_info(call_sid)
+		except Exception:
+			frappe.log_error(title=_("Failed to fetch Twilio call {0}").format(call_sid))
+			continue
+		updates[call_sid] = {
+			'status': TwilioCallDetails.get_call_status(call_details.status),
+			'duration': cint(call_details.duration)
+		}
+
+	bulk_update('Call Log', updates)
+	frappe.db.commit()
+
 @frappe.whitelist()
 def get_contact_details(phone):
 	"""Get information about existing contact in the system.
@@ -122,12 +255,24 @@ def incoming_whatsapp_message_handler(**kwargs):
 	"""This is a webhook called by Twilio when a WhatsApp message is received.
 	"""
 	args = frappe._dict(kwargs)
-	incoming_message_callback(args)
-	resp = MessagingResponse()
+	if is_first_delivery('whatsapp', args.MessageSid):
+		try:
+			buffer_incoming_message(args)
+		except Exception:
+			forget_delivery('whatsapp', args.MessageSid)
+			raise
+	return Response(get_whatsapp_reply().to_xml(), mimetype='text/xml')
 
-	# Add a message
-	resp.message(frappe.db.get_single_value('Twilio Settings', 'reply_message'))
-	return Response(resp.to_xml(), mimetype='text/xml')
+def get_whatsapp_reply():
+	"""Auto reply to incoming WhatsApp messages, compiled once per settings version.
+	"""
+	settings = frappe.get_cached_doc('Twilio Settings')
+	return get_twiml_template('whatsapp_reply', settings, lambda: build_whatsapp_reply(settings.reply_message)).render()
+
+def build_whatsapp_reply(message):
+	resp = MessagingResponse()
+	resp.message(message)
+	return resp
 
 @frappe.whitelist(allow_guest=True)
 def whatsapp_message_status_callback(**kwargs):
@@ -135,35 +280,27 @@ def whatsapp_message_status_callback(**kwargs):
 	"""
 	args = frappe._dict(kwargs)
 	try:
-		if frappe.db.exists({'doctype': 'WhatsApp Message', 'id': args.MessageSid, 'from_': args.From, 'to': args.To}):
-			message = frappe.get_doc('WhatsApp Message', {'id': args.MessageSid, 'from_': args.From, 'to': args.To})
-			
-			# Update status with enhanced error handling
-			new_status = args.MessageStatus.title()
-			message.db_set('status', new_status)
-			
-			# Log template-related errors specifically
-			if new_status == 'Failed' and hasattr(args, 'ErrorCode'):
-				error_details = f"Error Code: {args.ErrorCode}"
-				if hasattr(args, 'ErrorMessage'):
-					error_details += f", Message: {args.ErrorMessage}"
-				
-				# Check for template-specific errors
-				if args.ErrorCode == '63016':
-					error_details += " - This error occurs when sending freeform messages outside the 24-hour window. Use WhatsApp Template mode instead."
-				
-				frappe.log_error(
-					title=f"WhatsApp Message Failed - {args.MessageSid}",
-					message=error_details
-				)
-			
+		# Buffered callbacks are applied in batches by `flush_status_callbacks`
+		if frappe.get_cached_doc('Twilio Settings').buffer_status_callbacks:
+			buffer_status_callback(args)
+		elif process_status_callback(args):
 			frappe.db.commit()
+		else:
+			# The message may not be stored with its SID yet, `flush_status_callbacks` retries it
+			park_unmatched_status_callbacks([args])
 	except Exception as e:
 		frappe.log_error(
 			title="WhatsApp Status Callback Error",
 			message=f"Failed to process status callback: {str(e)}\nArgs: {args}"
 		)
 
+@frappe.whitelist()
+def get_status_callback_metrics():
+	"""Backlog and stall state of buffered WhatsApp status callbacks.
+	"""
+	frappe.only_for('System Manager')
+	return get_status_callback_buffer_metrics()
+
 @frappe.whitelist()
 def get_approved_whatsapp_templates():
 	"""Get list of approved WhatsApp templates for notifications"""
@@ -180,7 +317,7 @@ def test_whatsapp_template(template_name, test_variables=None):
 		return {"success": False, "message": "Template name is required"}
 	
 	try:
-		template_doc = frappe.get_doc('WhatsApp Message Template', template_name)
+		template_doc = get_compiled_template(template_name)
 		
 		if template_doc.template_status != 'Approved':
 			return {"success": False, "message": "Template is not approved"}
@@ -210,6 +347,30 @@ def test_whatsapp_template(template_name, test_variables=None):
 	except Exception as e:
 		return {"success": False, "message": str(e)}
 
+@frappe.whitelist()
+def send_whatsapp_template_batch(template_name, field_map=None, doctype=None, filters=None, csv_file=None,
+		recipient_field='whatsapp_no'):
+	"""Queue a personalized template send to the records of a DocType or the rows of an uploaded CSV.
+	`field_map` maps template variable positions to fields or CSV columns, e.g. {"1": "first_name"}.
+	Variables left out of it use the Source Field set on the template.
+	"""
+	frappe.only_for('System Manager')
+	if not (doctype or csv_file):
+		frappe.throw(_("Either a DocType or a CSV file is required"))
+
+	frappe.enqueue(
+		'twilio_integration.twilio_integration.doctype.whatsapp_message.whatsapp_message.send_template_batch',
+		queue='long',
+		timeout=4 * 60 * 60,
+		template_name=template_name,
+		field_map=field_map,
+		doctype=doctype,
+		filters=filters,
+		csv_file=csv_file,
+		recipient_field=recipient_field
+	)
+	return {"success": True, "message": "Template send queued"}
+
 @frappe.whitelist()
 def check_session_window(phone_number):
 	"""Check if phone number is within 24-hour session window"""
@@ -0,0 +1,113 @@
+"""Micro-benchmarks for the hot paths of the integration.
+
+Run against a test site only, they insert and remove synthetic records.
+Results are returned, and so printed by `bench execute`:
+	bench --site test_site execute twilio_integration.twilio_integration.benchmarks.status_callback_latency
+	bench --site test_site execute twilio_integration.twilio_integration.benchmarks.twiml_render
+"""
+import time
+import random
+
+import frappe
+from frappe.utils import now_datetime, add_to_date, cint
+
+from .api import whatsapp_message_status_callback
+from .twilio_handler import Twilio
+from .doctype.whatsapp_message.whatsapp_message import WhatsAppMessage
+
+BENCHMARK_SID_PREFIX = 'SMBENCH'
+BENCHMARK_SENDER = 'whatsapp:+10000000000'
+
+
+def timed(func, *args, **kwargs):
+	start = time.perf_counter()
+	func(*args, **kwargs)
+	return (time.perf_counter() - start) * 1000
+
+def summarize(timings):
+	timings = sorted(timings)
+	return {
+		'median_ms': round(timings[len(timings) // 2], 3),
+		'p95_ms': round(timings[int(len(timings) * 0.95)], 3)
+	}
+
+def log_benchmark(benchmark, step, result):
+	"""Progress of a long benchmark, `bench execute` prints the full results only once it returns.
+	"""
+	frappe.logger('twilio_integration').info('Benchmark {} {}: {}'.format(benchmark, step, result))
+
+def insert_benchmark_messages(start, end):
+	now = now_datetime()
+	fields = ['name', 'creation', 'modified', 'owner', 'modified_by', 'docstatus', 'idx', 'id', 'type',
+		'sent_received', 'from_', 'to', 'status', 'send_on', 'message']
+	values = []
+	for i in range(start, end):
+		incoming = i % 2
+		number = 'whatsapp:+1{:010d}'.format(i % 5000)
+		values.append([
+			'{}{:026d}'.format(BENCHMARK_SID_PREFIX, i), now, now, 'Administrator', 'Administrator', 0, 0,
+			'{}{:026d}'.format(BENCHMARK_SID_PREFIX, i),
+			'Incoming' if incoming else 'Outgoing',
+			'Received' if incoming else 'Sent',
+			number if incoming else BENCHMARK_SENDER,
+			BENCHMARK_SENDER if incoming else number,
+			'Received' if incoming else 'Queued',
+			add_to_date(now, minutes=-i),
+			'benchmark'
+		])
+	frappe.db.bulk_insert('WhatsApp Message', fields, values)
+	frappe.db.commit()
+
+def status_callback_latency(sizes='1000,10000,100000', samples=200):
+	"""Time status callbacks and session window checks while the message table grows.
+	With the indexes in place both stay flat across table sizes.
+	"""
+	samples = cint(samples)
+	results = {}
+	inserted = 0
+	try:
+		for size in sorted(cint(s) for s in sizes.split(',')):
+			insert_benchmark_messages(inserted, size)
+			inserted = size
+
+			callback_timings, session_timings = [], []
+			for _ in range(samples):
+				i = random.randrange(0, size, 2) # outgoing rows
+				callback_timings.append(timed(whatsapp_message_status_callback,
+					MessageSid='{}{:026d}'.format(BENCHMARK_SID_PREFIX, i),
+					From=BENCHMARK_SENDER,
+					To='whatsapp:+1{:010d}'.format(i % 5000),
+					MessageStatus='delivered'
+				))
+				session_timings.append(timed(WhatsAppMessage.is_in_session_window,
+					'whatsapp:+1{:010d}'.format(random.randrange(1, min(size, 5000), 2))))
+
+			results[size] = {
+				'status_callback': summarize(callback_timings),
+				'session_window': summarize(session_timings)
+			}
+			log_benchmark('status_callback_latency', size, results[size])
+	finally:
+		frappe.db.sql("DELETE FROM `tabWhatsApp Message` WHERE `id` LIKE %s", BENCHMARK_SID_PREFIX + '%')
+		frappe.db.commit()
+
+	return results
+
+def twiml_render(iterations=10000):
+	"""Compare building and serializing a `VoiceResponse` tree per webhook with rendering the compiled skeleton.
+	"""
+	iterations = cint(iterations)
+	twilio = Twilio(frappe.get_cached_doc('Twilio Settings'))
+	numbers = ['+1{:010d}'.format(i) for i in range(iterations)]
+
+	results = {}
+	for name, render in (
+		('tree', lambda number: twilio.build_dial_response(BENCHMARK_SENDER, number).to_xml()),
+		('compiled', lambda number: twilio.generate_twilio_dial_response(BENCHMARK_SENDER, number).to_xml())
+	):
+		timings = [timed(render, number) for number in numbers]
+		results[name] = summarize(timings)
+		results[name]['responses_per_second'] = round(1000 * len(timings) / sum(timings))
+		log_benchmark('twiml_render', name, results[name])
+
+	return results
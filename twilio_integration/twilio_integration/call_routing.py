@@ -0,0 +1,116 @@
+"""Call distribution strategies that pick one attender among the available owners of a Twilio number.
+
+Counters and timestamps live in redis, so every web worker and node sees the same distribution state.
+"""
+import abc
+import time
+
+import frappe
+
+from .utils import normalize_phone_number
+
+FIRST_AVAILABLE = 'First Available'
+ROUND_ROBIN = 'Round Robin'
+LEAST_RECENTLY_CALLED = 'Least Recently Called'
+LONGEST_IDLE = 'Longest Idle'
+
+LAST_ASSIGNED = 'twilio_agent_last_assigned'
+LAST_CALL_ENDED = 'twilio_agent_last_call_ended'
+# Phone number -> user of attenders that take calls on their phone, to tell whose dialled call ended
+DIALLED_ATTENDERS = 'twilio_dialled_attenders'
+
+
+class RoutingStrategy(abc.ABC):
+	def __init__(self, phone_number):
+		self.phone_number = phone_number
+		self.cache = frappe.cache()
+
+	@abc.abstractmethod
+	def choose(self, attenders):
+		"""Pick one of `attenders`, a list of owner details sorted by name.
+		"""
+
+	def route(self, attenders):
+		attender = self.choose(attenders)
+		self.cache.zadd(self.cache.make_key(LAST_ASSIGNED), {attender['name']: time.time()})
+		return attender
+
+	def get_scores(self, name, attenders):
+		"""Score of every attender in the sorted set `name`, 0 for attenders that are not in it.
+		"""
+		key = self.cache.make_key(name)
+		pipeline = self.cache.pipeline(transaction=False)
+		for attender in attenders:
+			pipeline.zscore(key, attender['name'])
+		return [score or 0 for score in pipeline.execute()]
+
+
+class FirstAvailable(RoutingStrategy):
+	def choose(self, attenders):
+		return attenders[0]
+
+
+class RoundRobin(RoutingStrategy):
+	"""Rotate through the attenders with a counter per Twilio number.
+	"""
+	def choose(self, attenders):
+		counter = self.cache.incr(self.cache.make_key('twilio_round_robin::{}'.format(self.phone_number)))
+		return attenders[counter % len(attenders)]
+
+
+class LeastRecentlyCalled(RoutingStrategy):
+	"""Pick the attender who was handed a call the longest time ago, on any number.
+	"""
+	def choose(self, attenders):
+		last_assigned = self.get_scores(LAST_ASSIGNED, attenders)
+		return attenders[min(range(len(attenders)), key=lambda i: last_assigned[i])]
+
+
+class LongestIdle(RoutingStrategy):
+	"""Pick the attender whose last activity, taking or finishing a call, is the oldest.
+	Unlike least recently called, an attender stuck on a long call is not picked before the others:
+	attenders handed a call that has not ended yet are busy and only picked when everyone is.
+	"""
+	def choose(self, attenders):
+		last_assigned = self.get_scores(LAST_ASSIGNED, attenders)
+		last_ended = self.get_scores(LAST_CALL_ENDED, attenders)
+		ranks = [(assigned > ended, max(assigned, ended)) for assigned, ended in zip(last_assigned, last_ended)]
+		return attenders[min(range(len(attenders)), key=lambda i: ranks[i])]
+
+
+ROUTING_STRATEGIES = {
+	FIRST_AVAILABLE: FirstAvailable,
+	ROUND_ROBIN: RoundRobin,
+	LEAST_RECENTLY_CALLED: LeastRecentlyCalled,
+	LONGEST_IDLE: LongestIdle
+}
+
+def get_routing_strategy(phone_number):
+	"""Strategy configured for the Twilio number in `Twilio Settings`, or the default one.
+	"""
+	settings = frappe.get_cached_doc('Twilio Settings')
+	strategy = settings.default_call_routing
+	for rule in settings.call_routing_rules:
+		if rule.twilio_number == phone_number:
+			strategy = rule.routing_strategy
+			break
+	return ROUTING_STRATEGIES.get(strategy, FirstAvailable)(phone_number)
+
+def set_call_ended(user):
+	cache = frappe.cache()
+	cache.zadd(cache.make_key(LAST_CALL_ENDED), {user: time.time()})
+
+def set_dialled_attender(number, user):
+	frappe.cache().hset(DIALLED_ATTENDERS, get_dialled_number_key(number), user)
+
+def set_dialled_call_ended(number):
+	"""Record the end of a call forwarded to the phone of an attender, who has no browser to report it.
+	"""
+	user = number and frappe.cache().hget(DIALLED_ATTENDERS, get_dialled_number_key(number))
+	if user:
+		set_call_ended(user)
+
+def get_dialled_number_key(number):
+	"""Twilio reports dialled numbers in E.164, whatever format the attender's mobile number is saved in.
+	"""
+	return normalize_phone_number(number, frappe.get_cached_doc('Twilio Settings').default_country_code) or number
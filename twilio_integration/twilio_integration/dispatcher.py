@@ -0,0 +1,201 @@
+import time
+import asyncio
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+
+import frappe
+from frappe.utils import cint
+from twilio.base.exceptions import TwilioRestException
+
+from .twilio_handler import Twilio, AsyncTwilioTransport, HTTP_TIMEOUT, get_retry_after
+from .rate_limiter import get_rate_governor
+
+DEFAULT_CONCURRENCY = 4
+MAX_THROTTLE_RETRIES = 3
+THROTTLE_BACKOFF = 1 # seconds, doubled on every retry
+
+# Twilio errors that fail the same way however often they are retried:
+# invalid or non mobile numbers, unsubscribed recipients, freeform messages outside the session window.
+NON_RETRYABLE_ERROR_CODES = {21211, 21610, 21614, 63016}
+
+
+class DispatchResult:
+	def __init__(self, key, response=None, error=None, latency=0, throttled=0):
+		self.key = key
+		self.response = response
+		self.error = error
+		self.latency = latency
+		self.throttled = throttled
+
+
+class DispatchStats:
+	"""Latency and throughput of one dispatched batch.
+	"""
+	def __init__(self, results, elapsed):
+		latencies = [r.latency for r in results]
+		self.count = len(results)
+		self.sent = len([r for r in results if not r.error])
+		self.failed = self.count - self.sent
+		# Failed messages put back in the outbox, counted by the caller that decides on retries
+		self.retrying = 0
+		self.throttled = sum(r.throttled for r in results)
+		self.elapsed = elapsed
+		self.avg_latency = latencies and sum(latencies) / len(latencies) or 0
+		self.max_latency = max(latencies or [0])
+
+	@property
+	def throughput(self):
+		"""Messages per second over the batch.
+		"""
+		return self.elapsed and self.count / self.elapsed or 0
+
+	def as_dict(self):
+		return {
+			'count': self.count,
+			'sent': self.sent,
+			'failed': self.failed,
+			'retrying': self.retrying,
+			'throttled': self.throttled,
+			'elapsed': round(self.elapsed, 3),
+			'avg_latency': round(self.avg_latency, 3),
+			'max_latency': round(self.max_latency, 3),
+			'throughput': round(self.throughput, 2)
+		}
+
+
+class WhatsAppDispatcher:
+	"""Keeps up to `max_workers` Twilio `messages.create` calls in flight over a shared client.
+
+	Worker threads only talk to Twilio. Persisting the results is left to the calling thread,
+	since database connections are bound to the thread that opened them.
+	>>> with WhatsAppDispatcher(client, max_workers=8) as dispatcher:
+	...	results, stats = dispatcher.dispatch([(key, message_dict), ...])
+	"""
+	def __init__(self, client, max_workers=DEFAULT_CONCURRENCY, limiter=None,
+			max_retries=MAX_THROTTLE_RETRIES, backoff=THROTTLE_BACKOFF):
+		self.client = client
+		self.max_workers = max_workers
+		self.limiter = limiter
+		self.max_retries = max_retries
+		self.backoff = backoff
+		self.executor = None
+
+	def __enter__(self):
+		self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='twilio-dispatch')
+		return self
+
+	def __exit__(self, *args):
+		self.executor.shutdown(wait=True)
+		self.executor = None
+
+	def dispatch(self, messages):
+		"""Send `messages`, an iterable of (key, message_dict) pairs.
+		Returns the results in input order along with the batch stats.
+		"""
+		start = time.monotonic()
+		results = list(self.executor.map(lambda message: self.send(*message), messages))
+		return results, DispatchStats(results, time.monotonic() - start)
+
+	def send(self, key, message_dict):
+		"""Create one message, backing off while Twilio answers 429 Too Many Requests.
+		With a rate governor the backoff is left to the governor, which also honours `Retry-After`.
+		"""
+		start = time.monotonic()
+		throttled = 0
+		sender = message_dict.get('from_')
+		while True:
+			if self.limiter:
+				self.limiter.acquire(sender)
+			try:
+				response = self.client.messages.create(**message_dict)
+				return DispatchResult(key, response=response, latency=time.monotonic() - start, throttled=throttled)
+			except TwilioRestException as e:
+				if e.status == 429 and self.limiter:
+					self.limiter.throttled(sender, e, get_retry_after(e, self.client))
+				if self.should_retry(e, throttled):
+					if not self.limiter:
+						time.sleep(self.backoff * 2 ** throttled)
+					throttled += 1
+					continue
+				return DispatchResult(key, error=e, latency=time.monotonic() - start, throttled=throttled)
+			except Exception as e:
+				return DispatchResult(key, error=e, latency=time.monotonic() - start, throttled=throttled)
+
+	def should_retry(self, error, throttled):
+		return error.status == 429 and throttled < self.max_retries
+
+
+class AsyncWhatsAppDispatcher(WhatsAppDispatcher):
+	"""Same interface as `WhatsAppDispatcher`, but the requests are kept in flight on one event loop
+	through `AsyncTwilioTransport`, so a single worker can hold hundreds of them open.
+	"""
+	def __init__(self, client, max_workers=DEFAULT_CONCURRENCY, limiter=None,
+			max_retries=MAX_THROTTLE_RETRIES, backoff=THROTTLE_BACKOFF, timeout=HTTP_TIMEOUT):
+		super().__init__(client, max_workers=max_workers, limiter=limiter, max_retries=max_retries, backoff=backoff)
+		self.timeout = timeout
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		pass
+
+	def dispatch(self, messages):
+		return asyncio.run(self.dispatch_async(list(messages)))
+
+	async def dispatch_async(self, messages):
+		start = time.monotonic()
+		async with AsyncTwilioTransport(self.client, max_concurrency=self.max_workers, timeout=self.timeout) as transport:
+			results = await asyncio.gather(*[self.send_async(transport, *message) for message in messages])
+		return list(results), DispatchStats(results, time.monotonic() - start)
+
+	async def send_async(self, transport, key, message_dict):
+		start = time.monotonic()
+		throttled = 0
+		sender = message_dict.get('from_')
+		loop = asyncio.get_running_loop()
+		while True:
+			if self.limiter:
+				# The limiter sleeps, keep it off the event loop
+				await loop.run_in_executor(None, self.limiter.acquire, sender)
+			try:
+				response = await transport.create_message(**message_dict)
+				return DispatchResult(key, response=response, latency=time.monotonic() - start, throttled=throttled)
+			except TwilioRestException as e:
+				if e.status == 429 and self.limiter:
+					await loop.run_in_executor(None, self.limiter.throttled, sender, e, get_retry_after(e))
+				if self.should_retry(e, throttled):
+					if not self.limiter:
+						await asyncio.sleep(self.backoff * 2 ** throttled)
+					throttled += 1
+					continue
+				return DispatchResult(key, error=e, latency=time.monotonic() - start, throttled=throttled)
+			except Exception as e:
+				return DispatchResult(key, error=e, latency=time.monotonic() - start, throttled=throttled)
+
+
+def is_retryable_error(error):
+	"""Whether a failed send may succeed later: throttling, Twilio server errors, timeouts and connection errors.
+	"""
+	if isinstance(error, TwilioRestException):
+		if error.code in NON_RETRYABLE_ERROR_CODES:
+			return False
+		return error.status == 429 or (error.status or 0) >= 500
+	return True
+
+def get_whatsapp_dispatcher(limiter=None):
+	"""Dispatcher over this worker's pooled client, sized by `Twilio Settings`.
+	Sends are paced by the shared rate governor unless another `limiter` is given.
+	"""
+	settings = frappe.get_cached_doc("Twilio Settings")
+	concurrency = cint(settings.max_concurrent_requests) or DEFAULT_CONCURRENCY
+	dispatcher_class = WhatsAppDispatcher
+	if settings.async_transport:
+		if importlib.util.find_spec('httpx'):
+			dispatcher_class = AsyncWhatsAppDispatcher
+		else:
+			frappe.logger("twilio_integration").warning("httpx is not installed, sending WhatsApp messages over threads")
+	return dispatcher_class(Twilio.get_twilio_client(), max_workers=concurrency, limiter=limiter or get_rate_governor())
+
+def log_dispatch_stats(stats):
+	frappe.logger("twilio_integration").info("WhatsApp dispatch batch: {}".format(stats.as_dict()))
@@ -0,0 +1,58 @@
+# Copyright (c) 2026, Frappe and Contributors
+# See license.txt
+
+import frappe
+import unittest
+from unittest.mock import patch, PropertyMock
+
+from twilio_integration.twilio_integration.twilio_handler import Twilio
+from twilio_integration.twilio_integration.doctype.twilio_phone_number.twilio_phone_number import get_phone_numbers
+
+VOICE_NUMBER = '+10000000101'
+MESSAGING_NUMBER = '+10000000102'
+
+class TestTwilioPhoneNumber(unittest.TestCase):
+	def setUp(self):
+		for phone_number, voice, sms, whatsapp in ((VOICE_NUMBER, 1, 0, 0), (MESSAGING_NUMBER, 0, 1, 1)):
+			frappe.get_doc({
+				'doctype': 'Twilio Phone Number',
+				'phone_number': phone_number,
+				'voice': voice,
+				'sms': sms,
+				'whatsapp': whatsapp
+			}).insert(ignore_permissions=True)
+
+	def tearDown(self):
+		for phone_number in (VOICE_NUMBER, MESSAGING_NUMBER):
+			frappe.delete_doc('Twilio Phone Number', phone_number, ignore_permissions=True)
+
+	def test_inventory_filtered_by_capability(self):
+		self.assertIn(VOICE_NUMBER, get_phone_numbers('Voice'))
+		self.assertNotIn(MESSAGING_NUMBER, get_phone_numbers('Voice'))
+		self.assertIn(MESSAGING_NUMBER, get_phone_numbers('SMS'))
+		self.assertIn(MESSAGING_NUMBER, get_phone_numbers('WhatsApp'))
+		self.assertTrue({VOICE_NUMBER, MESSAGING_NUMBER} <= set(get_phone_numbers()))
+
+	def test_cache_cleared_on_update(self):
+		self.assertNotIn(MESSAGING_NUMBER, get_phone_numbers('Voice'))
+		doc = frappe.get_doc('Twilio Phone Number', MESSAGING_NUMBER)
+		doc.voice = 1
+		doc.save(ignore_permissions=True)
+		self.assertIn(MESSAGING_NUMBER, get_phone_numbers('Voice'))
+
+	def test_unknown_capability(self):
+		self.assertRaises(frappe.ValidationError, get_phone_numbers, 'Fax')
+
+	def test_live_numbers_filtered_by_capability(self):
+		records = [
+			frappe._dict(phone_number=VOICE_NUMBER, capabilities={'voice': True, 'sms': False}),
+			frappe._dict(phone_number=MESSAGING_NUMBER, capabilities={'voice': False, 'sms': True})
+		]
+		client = frappe._dict(incoming_phone_numbers=frappe._dict(list=lambda: records))
+		twilio = Twilio(frappe._dict(whatsapp_no='whatsapp:' + MESSAGING_NUMBER))
+
+		with patch.object(Twilio, 'twilio_client', new_callable=PropertyMock, return_value=client):
+			self.assertEqual(twilio.get_phone_numbers('Voice'), [VOICE_NUMBER])
+			self.assertEqual(twilio.get_phone_numbers('SMS'), [MESSAGING_NUMBER])
+			self.assertEqual(twilio.get_phone_numbers('WhatsApp'), [MESSAGING_NUMBER])
+			self.assertEqual(twilio.get_phone_numbers(), [VOICE_NUMBER, MESSAGING_NUMBER])
@@ -0,0 +1,105 @@
+# Copyright (c) 2026, Frappe and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe import _
+from frappe.model.document import Document
+
+from ...twilio_handler import Twilio
+from ...utils import acquire_lock, release_lock
+
+PHONE_NUMBERS_CACHE = 'twilio_phone_numbers'
+SYNC_LOCK = 'twilio_phone_number_sync'
+SYNC_LOCK_TIMEOUT = 30 * 60
+SYNC_PAGE_SIZE = 100
+CAPABILITY_FIELDS = {
+	'Voice': 'voice',
+	'SMS': 'sms',
+	'WhatsApp': 'whatsapp'
+}
+
+class TwilioPhoneNumber(Document):
+	def on_update(self):
+		clear_phone_numbers_cache()
+
+	def on_trash(self):
+		clear_phone_numbers_cache()
+
+def get_phone_numbers(capability=None):
+	"""Numbers of the inventory, only those with `capability` (Voice, SMS or WhatsApp) if it is given.
+	"""
+	if capability and capability not in CAPABILITY_FIELDS:
+		frappe.throw(_("Unknown phone number capability {0}").format(capability))
+	return frappe.cache().hget(PHONE_NUMBERS_CACHE, capability or 'All',
+		generator=lambda: load_phone_numbers(capability))
+
+def load_phone_numbers(capability=None):
+	filters = {CAPABILITY_FIELDS[capability]: 1} if capability else {}
+	return frappe.get_all('Twilio Phone Number', filters=filters, pluck='name', order_by='name')
+
+def clear_phone_numbers_cache():
+	frappe.cache().delete_key(PHONE_NUMBERS_CACHE)
+
+def enqueue_phone_number_sync():
+	frappe.enqueue(
+		'twilio_integration.twilio_integration.doctype.twilio_phone_number.twilio_phone_number.sync_phone_numbers',
+		queue='long',
+		job_name=SYNC_LOCK,
+		enqueue_after_commit=True
+	)
+
+def sync_phone_numbers():
+	"""Walk the account's incoming numbers page by page and apply the changes to the inventory.
+	Only numbers that are new, or were updated on Twilio since the last sync, are written.
+	Numbers that are no longer on the account are removed once the walk is complete.
+	"""
+	twilio = Twilio.connect()
+	lock_token = twilio and acquire_lock(SYNC_LOCK, SYNC_LOCK_TIMEOUT)
+	if not lock_token:
+		return
+
+	try:
+		whatsapp_number = twilio.get_whatsapp_number()
+		existing = {d.name: d for d in frappe.get_all('Twilio Phone Number', fields=['name', 'date_updated', 'whatsapp'])}
+		seen = set()
+
+		page = twilio.twilio_client.incoming_phone_numbers.page(page_size=SYNC_PAGE_SIZE)
+		while page:
+			for record in page:
+				seen.add(record.phone_number)
+				date_updated = record.date_updated and record.date_updated.replace(tzinfo=None)
+				is_whatsapp_number = record.phone_number == whatsapp_number
+				current = existing.get(record.phone_number)
+				if current and current.date_updated == date_updated and (current.whatsapp or not is_whatsapp_number):
+					continue
+				save_phone_number(record, date_updated, is_whatsapp_number)
+			frappe.db.commit()
+			page = page.next_page()
+
+		for phone_number in set(existing) - seen:
+			frappe.delete_doc('Twilio Phone Number', phone_number, ignore_permissions=True)
+		frappe.db.commit()
+	finally:
+		release_lock(SYNC_LOCK, lock_token)
+		clear_phone_numbers_cache()
+
+def save_phone_number(record, date_updated, whatsapp=False):
+	if frappe.db.exists('Twilio Phone Number', record.phone_number):
+		doc = frappe.get_doc('Twilio Phone Number', record.phone_number)
+	else:
+		doc = frappe.new_doc('Twilio Phone Number')
+		doc.phone_number = record.phone_number
+
+	capabilities = record.capabilities or {}
+	doc.update({
+		'friendly_name': record.friendly_name,
+		'sid': record.sid,
+		'voice': int(bool(capabilities.get('voice'))),
+		'sms': int(bool(capabilities.get('sms'))),
+		'date_updated': date_updated
+	})
+	if whatsapp:
+		doc.whatsapp = 1
+
+	doc.flags.ignore_permissions = True
+	doc.save()
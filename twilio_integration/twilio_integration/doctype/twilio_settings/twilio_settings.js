@@ -14,5 +14,19 @@ frappe.ui.form.on('Twilio Settings', {
 	},
 	refresh: function(frm) {
 		frm.dashboard.set_headline(__("For more information, {0}.", [`<a href='https://docs.erpnext.com/docs/user/manual/en/setting-up/notifications'>${__('Click here')}</a>`]));
+
+		if (frm.doc.enabled) {
+			frm.add_custom_button(__('Sync Phone Numbers'), function() {
+				frappe.call({
+					method: "twilio_integration.twilio_integration.api.sync_twilio_phone_numbers",
+					callback: function() {
+						frappe.show_alert({
+							message: __('Phone numbers will be synced in the background'),
+							indicator: 'green'
+						});
+					}
+				});
+			});
+		}
 	}
 });
@@ -15,6 +15,8 @@ from random import randrange
 
 from twilio.rest import Client
 from ...utils import get_public_url
+from ...twilio_handler import clear_twilio_client_cache
+from ..twilio_phone_number.twilio_phone_number import enqueue_phone_number_sync
 
 class TwilioSettings(Document):
 	friendly_resource_name = "ERPNext" # System creates TwiML app & API keys with this name.
@@ -23,6 +25,8 @@ class TwilioSettings(Document):
 		self.validate_twilio_account()
 
 	def on_update(self):
+		clear_twilio_client_cache()
+
 		# Single doctype records are created in DB at time of installation and those field values are set as null.
 		# This condition make sure that we handle null.
 		if not self.account_sid:
@@ -33,6 +37,9 @@ class TwilioSettings(Document):
 		self.set_application_credentials(twilio)
 		self.reload()
 
+		if self.enabled:
+			enqueue_phone_number_sync()
+
 	def validate_twilio_account(self):
 		try:
 			twilio = Client(self.account_sid, self.get_password("auth_token"))
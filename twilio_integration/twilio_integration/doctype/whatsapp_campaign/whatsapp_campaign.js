@@ -16,6 +16,13 @@ frappe.ui.form.on('WhatsApp Campaign', {
 						});
 					})
 					frappe.meta.get_docfield('WhatsApp Campaign Recipient', 'campaign_for', frm.doc.name).options = [""].concat(options);
+					frm.set_query('recipient_doctype', () => {
+						return {
+							filters: {
+								name: ['in', r.message]
+							}
+						};
+					});
 				}
 			}
 		});
@@ -26,8 +33,13 @@ frappe.ui.form.on('WhatsApp Campaign', {
 			frm.disable_form();
 			frm.disable_save();
 		}
+		if(frm.doc.status == 'In Progress') {
+			frm.dashboard.set_headline(__('Sending in background: {0} sent, {1} failed, {2} skipped of {3} recipients.',
+				[frm.doc.sent_count, frm.doc.failed_count, frm.doc.skipped_count, frm.doc.total_participants]));
+		}
 		if(!frm.is_new() && frm.doc.status!='Completed') {
-			frm.add_custom_button(('Send Now'), function(){
+			let label = frm.doc.status == 'In Progress' ? __('Resume') : __('Send Now');
+			frm.add_custom_button(label, function(){
 				frappe.call({
 					doc: frm.doc,
 					method: 'send_now',
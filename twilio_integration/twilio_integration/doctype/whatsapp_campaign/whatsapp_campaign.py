@@ -2,9 +2,14 @@
 # For license information, please see license.txt
 
 import frappe
+from frappe import _
 from frappe.model.document import Document
-from frappe.utils import get_site_url
-from twilio_integration.twilio_integration.doctype.whatsapp_message.whatsapp_message import WhatsAppMessage
+from frappe.utils import get_site_url, now_datetime, add_to_date, create_batch
+from frappe.utils.background_jobs import get_jobs
+from twilio_integration.twilio_integration.doctype.whatsapp_message.whatsapp_message import WhatsAppMessage, \
+	get_unique_receivers
+from twilio_integration.twilio_integration.dispatcher import get_whatsapp_dispatcher
+from twilio_integration.twilio_integration.utils import filter_new_set_members, add_set_members
 
 supported_file_ext = ['jpg', 
 	'jpeg',
@@ -16,6 +21,15 @@ supported_file_ext = ['jpg',
 	'mp4'
 ]
 
+CAMPAIGN_CHUNK_SIZE = 500
+DISPATCH_BATCH_SIZE = 50
+# In Progress campaigns without any progress for this long are considered abandoned by their worker.
+STALLED_CAMPAIGN_MINUTES = 10
+SCHEDULED_CAMPAIGN_BATCH_SIZE = 100
+# Numbers a campaign has sent to are remembered this long (seconds) to skip duplicates across chunks.
+SENT_NUMBERS_EXPIRY = 7 * 24 * 60 * 60
+FAILED_STATUSES = ('Error', 'Dead Letter')
+
 class WhatsAppCampaign(Document):
 	def validate(self):
 		if self.scheduled_time and self.status != 'Completed':
@@ -54,9 +68,29 @@ class WhatsAppCampaign(Document):
 		return contacts
 	
 	def all_missing_recipients(self):
+		"""Fill missing WhatsApp numbers with one query per recipient DocType.
+		Campaigns sent to a whole DocType only count their recipients, they are read while sending.
+		"""
+		if self.recipient_doctype:
+			self.total_participants = frappe.db.count(self.recipient_doctype, get_recipient_filters(self.condition))
+			return
+
+		if not self.recipients:
+			frappe.throw(_("Add recipients or select a DocType to send the campaign to."))
+
+		missing = {}
+		for recipient in self.recipients:
+			if not recipient.whatsapp_no:
+				missing.setdefault(recipient.campaign_for, set()).add(recipient.recipient)
+
+		numbers = {}
+		for doctype, names in missing.items():
+			for row in frappe.get_all(doctype, filters={'name': ['in', list(names)]}, fields=['name', 'whatsapp_no']):
+				numbers[(doctype, row.name)] = row.whatsapp_no
+
 		for recipient in self.recipients:
 			if not recipient.whatsapp_no:
-				recipient.whatsapp_no = frappe.db.get_value(recipient.campaign_for, recipient.recipient, 'whatsapp_no')
+				recipient.whatsapp_no = numbers.get((recipient.campaign_for, recipient.recipient))
 		
 		self.total_participants = len(self.recipients)
 
@@ -74,20 +108,206 @@ class WhatsAppCampaign(Document):
 
 	@frappe.whitelist()
 	def send_now(self):
+		"""Queue the campaign for background sending.
+		Campaigns that are already In Progress resume from the last dispatched recipient,
+		unless a chunk job of the campaign is still queued or running.
+		"""
+		if self.status == 'Completed':
+			return
+
+		if is_campaign_job_queued(self.name):
+			frappe.msgprint(_("Campaign {0} is already being sent.").format(self.name))
+			return
+
 		self.validate_attachment()
 		media = self.get_attachment()
-		self.db_set('status', 'In Progress')
 		if media:
 			media = get_site_url(frappe.local.site) + media.file_url
 
-		WhatsAppMessage.send_whatsapp_message(
-			receiver_list = self.get_whatsapp_contact(),
-			message = self.message,
-			doctype = self.doctype,
-			docname = self.name,
-			media = media
+		self.db_set({'status': 'In Progress', 'send_on': self.send_on or now_datetime()})
+		enqueue_campaign_chunk(self.name, media)
+
+
+def get_campaign_job_name(campaign):
+	return 'whatsapp_campaign::{}'.format(campaign)
+
+def is_campaign_job_queued(campaign):
+	"""Whether a chunk job of the campaign is waiting in the queue or being run by a worker.
+	"""
+	site = frappe.local.site
+	jobs = get_jobs(site=site, queue='long', key='job_name').get(site) or []
+	return get_campaign_job_name(campaign) in jobs
+
+def enqueue_campaign_chunk(campaign, media=None):
+	frappe.enqueue(
+		'twilio_integration.twilio_integration.doctype.whatsapp_campaign.whatsapp_campaign.send_campaign_chunk',
+		queue='long',
+		job_name=get_campaign_job_name(campaign),
+		campaign=campaign,
+		media=media
+	)
+
+def send_campaign_chunk(campaign, media=None):
+	"""Send the next chunk of campaign recipients at the sender's rate and queue the chunk after it.
+	Progress is committed per dispatch batch, so a job lost with its worker resumes from `last_dispatched_idx`
+	and re-sends at most one batch.
+	"""
+	progress = frappe.db.get_value('WhatsApp Campaign', campaign,
+		['status', 'message', 'recipient_doctype', 'condition', 'last_dispatched_idx', 'last_dispatched_recipient'],
+		as_dict=True)
+	if not (progress and progress.status == 'In Progress'):
+		return
+
+	if progress.recipient_doctype:
+		recipients = get_doctype_recipients(progress.recipient_doctype, progress.condition, progress.last_dispatched_recipient)
+	else:
+		recipients = frappe.get_all('WhatsApp Campaign Recipient',
+			filters={
+				'parent': campaign,
+				'parenttype': 'WhatsApp Campaign',
+				'idx': ['>', progress.last_dispatched_idx or 0]
+			},
+			fields=['idx', 'whatsapp_no'],
+			order_by='idx asc',
+			limit_page_length=CAMPAIGN_CHUNK_SIZE
 		)
 
-		self.db_set('status', 'Completed')
+	if not recipients:
+		# Messages still in the outbox hand the campaign back once they are sent or failed for good
+		if not has_pending_retries(campaign):
+			frappe.db.set_value('WhatsApp Campaign', campaign, 'status', 'Completed')
+		frappe.db.commit()
+		return
+
+	sent_numbers = get_sent_numbers_key(campaign)
+
+	with get_whatsapp_dispatcher() as dispatcher:
+		for batch in create_batch(recipients, DISPATCH_BATCH_SIZE):
+			receivers, skipped = get_unique_receivers([recipient.whatsapp_no for recipient in batch if recipient.whatsapp_no])
+			# Numbers already sent to by an earlier batch of this campaign
+			numbers = filter_new_set_members(sent_numbers, [number for number, receiver in receivers])
+			sent = failed = 0
+			skipped_count = skipped['duplicates'] + skipped['invalid'] + len(receivers) - len(numbers)
+
+			wa_messages = WhatsAppMessage.store_whatsapp_messages(numbers, progress.message, 'WhatsApp Campaign', campaign, media)
+			if wa_messages:
+				stats = WhatsAppMessage.send_messages(wa_messages, dispatcher)
+				sent = stats.sent
+				# Messages waiting in the outbox are counted by it once they are sent or failed for good
+				failed = stats.failed - stats.retrying
+				# Numbers that failed for good are sent to again when the campaign is resumed,
+				# the ones waiting in the outbox are sent by it
+				add_set_members(sent_numbers, [number for number, wa_message in zip(numbers, wa_messages)
+					if wa_message.status not in FAILED_STATUSES], SENT_NUMBERS_EXPIRY)
+
+			increment_campaign_counts(campaign, sent=sent, failed=failed, skipped=skipped_count)
+			frappe.db.set_value('WhatsApp Campaign', campaign, {
+				'last_dispatched_idx': batch[-1].get('idx') or 0,
+				'last_dispatched_recipient': batch[-1].get('name')
+			})
+			frappe.db.commit()
+
+	enqueue_campaign_chunk(campaign, media)
+
+def increment_campaign_counts(campaign, sent=0, failed=0, skipped=0):
+	"""Add to the counters of a campaign in place, both the chunk job and the outbox count its messages.
+	"""
+	frappe.db.sql("""
+		UPDATE `tabWhatsApp Campaign`
+		SET `sent_count` = COALESCE(`sent_count`, 0) + %(sent)s,
+			`failed_count` = COALESCE(`failed_count`, 0) + %(failed)s,
+			`skipped_count` = COALESCE(`skipped_count`, 0) + %(skipped)s
+		WHERE `name` = %(campaign)s
+	""", {'campaign': campaign, 'sent': sent, 'failed': failed, 'skipped': skipped})
+
+def has_pending_retries(campaign):
+	return bool(frappe.db.exists('WhatsApp Message', {
+		'reference_doctype': 'WhatsApp Campaign',
+		'reference_document_name': campaign,
+		'status': 'Retrying'
+	}))
+
+def count_outbox_messages(campaign, sent=0, failed=0):
+	"""Count messages of the campaign that left the outbox, sent or failed for good.
+	Once none of its messages are left in the outbox, the campaign is handed back to its chunk job,
+	which completes it, or resumes it if the job was lost.
+	"""
+	increment_campaign_counts(campaign, sent=sent, failed=failed)
+	if has_pending_retries(campaign):
+		return
+
+	if frappe.db.get_value('WhatsApp Campaign', campaign, 'status') == 'In Progress':
+		frappe.get_doc('WhatsApp Campaign', campaign).send_now()
+
+def get_sent_numbers_key(campaign):
+	return 'whatsapp_campaign_numbers::{}'.format(campaign)
+
+def get_recipient_filters(condition):
+	"""Filters of a campaign sent to a whole DocType, from its JSON `condition`.
+	"""
+	filters = frappe.parse_json(condition) if condition else {}
+	if isinstance(filters, dict):
+		filters = [[key, *(value if isinstance(value, list) else ['=', value])] for key, value in filters.items()]
+	return filters + [['whatsapp_no', 'is', 'set']]
+
+def get_doctype_recipients(doctype, condition, after=None):
+	"""Next chunk of recipients of a campaign sent to a whole DocType.
+	Recipients are paged by name so that every chunk is one indexed range scan and a resumed job
+	continues right after the last dispatched recipient. A server side cursor is not usable here, as
+	messages are stored and progress committed on the same connection while the chunk is being sent.
+	"""
+	filters = get_recipient_filters(condition)
+	if after:
+		filters.append(['name', '>', after])
+
+	return frappe.get_all(doctype,
+		filters=filters,
+		fields=['name', 'whatsapp_no'],
+		order_by='name asc',
+		limit_page_length=CAMPAIGN_CHUNK_SIZE
+	)
+
+def send_scheduled_campaigns():
+	"""Claim campaigns whose scheduled time has passed and hand them to background sending.
+	A campaign is claimed by moving it from Scheduled to In Progress while its row is locked,
+	so when several schedulers pick the same campaign only the first one to lock it sends it.
+	"""
+	now = now_datetime()
+	due_campaigns = frappe.db.sql_list("""
+		SELECT `name` FROM `tabWhatsApp Campaign`
+		WHERE `status` = 'Scheduled' AND `scheduled_time` <= %s
+		ORDER BY `scheduled_time`
+		LIMIT %s
+	""", (now, SCHEDULED_CAMPAIGN_BATCH_SIZE))
+
+	for campaign in due_campaigns:
+		claimed = frappe.db.get_value('WhatsApp Campaign', campaign, 'status', for_update=True) == 'Scheduled'
+		if claimed:
+			frappe.db.set_value('WhatsApp Campaign', campaign, {'status': 'In Progress', 'send_on': now})
+		frappe.db.commit()
+
+		if not claimed:
+			continue
 
+		try:
+			frappe.get_doc('WhatsApp Campaign', campaign).send_now()
+		except Exception:
+			frappe.db.rollback()
+			# Failed campaigns are not picked up again, they are sent again with Send Now
+			frappe.db.set_value('WhatsApp Campaign', campaign, 'status', 'Failed')
+			error_log = frappe.log_error(title=_('Failed to start scheduled WhatsApp Campaign {0}').format(campaign))
+			frappe.get_doc('WhatsApp Campaign', campaign).add_comment('Comment',
+				_('Could not be started, see Error Log {0}').format(error_log.name))
+		frappe.db.commit()
 
+def resume_stalled_campaigns():
+	"""Re-queue In Progress campaigns whose worker died before finishing them.
+	"""
+	stalled_before = add_to_date(now_datetime(), minutes=-STALLED_CAMPAIGN_MINUTES)
+	campaigns = frappe.get_all('WhatsApp Campaign',
+		filters={'status': 'In Progress', 'modified': ['<', stalled_before]},
+		pluck='name'
+	)
+	for campaign in campaigns:
+		# Campaigns whose chunk job is still queued or running are skipped by `send_now`
+		frappe.get_doc('WhatsApp Campaign', campaign).send_now()
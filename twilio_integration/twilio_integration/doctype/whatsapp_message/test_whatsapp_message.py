@@ -1,8 +1,137 @@
 # Copyright (c) 2021, Frappe and Contributors
 # See license.txt
 
-# import frappe
+import frappe
 import unittest
+from unittest.mock import patch
+
+from twilio_integration.twilio_integration.utils import read_buffer
+from twilio_integration.twilio_integration.doctype.whatsapp_message.whatsapp_message import WhatsAppMessage, \
+	STATUS_LIFECYCLE, INCOMING_MESSAGE_BUFFER, INCOMING_MESSAGE_DEAD_LETTER, get_message_status, \
+	update_message_status, process_status_callback, buffer_incoming_message, flush_incoming_messages, \
+	insert_incoming_messages
 
 class TestWhatsAppMessage(unittest.TestCase):
-	pass
+	def tearDown(self):
+		frappe.db.rollback()
+
+	def insert_sent_message(self, status='Queued'):
+		message_sid = 'SM' + frappe.generate_hash(length=32)
+		WhatsAppMessage.insert_messages([{
+			'doctype': 'WhatsApp Message',
+			'type': 'Outgoing',
+			'from_': 'whatsapp:+10000000000',
+			'to': 'whatsapp:+10000000001',
+			'message': 'test',
+			'sent_received': 'Sent',
+			'status': status,
+			'id': message_sid
+		}])
+		return message_sid
+
+	def get_status(self, message_sid):
+		return frappe.db.get_value('WhatsApp Message', {'id': message_sid}, 'status')
+
+	def test_status_moves_forward_only(self):
+		message_sid = self.insert_sent_message()
+
+		self.assertTrue(update_message_status(message_sid, 'Sent'))
+		self.assertTrue(update_message_status(message_sid, 'Delivered'))
+		# Late and repeated callbacks
+		self.assertFalse(update_message_status(message_sid, 'Sent'))
+		self.assertFalse(update_message_status(message_sid, 'Delivered'))
+		self.assertFalse(update_message_status(message_sid, 'Failed'))
+		self.assertEqual(self.get_status(message_sid), 'Delivered')
+
+		self.assertTrue(update_message_status(message_sid, 'Read'))
+		self.assertEqual(self.get_status(message_sid), 'Read')
+
+	def test_errored_message_takes_twilio_status(self):
+		message_sid = self.insert_sent_message(status='Error')
+		self.assertTrue(update_message_status(message_sid, 'Delivered'))
+		self.assertEqual(self.get_status(message_sid), 'Delivered')
+
+	def test_unknown_message(self):
+		self.assertFalse(update_message_status('SM' + frappe.generate_hash(length=32), 'Delivered'))
+		self.assertFalse(update_message_status(None, 'Delivered'))
+
+	def test_process_status_callback(self):
+		message_sid = self.insert_sent_message()
+
+		self.assertFalse(process_status_callback(frappe._dict(MessageSid=message_sid, MessageStatus='sending')))
+		self.assertTrue(process_status_callback(frappe._dict(MessageSid=message_sid, MessageStatus='sent')))
+		self.assertFalse(process_status_callback(frappe._dict(MessageSid=message_sid, MessageStatus='queued')))
+		self.assertEqual(self.get_status(message_sid), 'Sent')
+
+	def test_statuses_are_options(self):
+		options = frappe.get_meta('WhatsApp Message').get_field('status').options.split('\n')
+		for status in ('accepted', 'scheduled', 'queued', 'sending', 'sent', 'delivered', 'undelivered', 'failed', 'read'):
+			self.assertIn(get_message_status(status), options)
+		for status in STATUS_LIFECYCLE:
+			self.assertIn(status, options)
+
+
+class TestIncomingMessageBuffer(unittest.TestCase):
+	def setUp(self):
+		self.message_sids = []
+		self.clear_buffers()
+
+	def tearDown(self):
+		frappe.db.delete('WhatsApp Message', {'id': ['in', self.message_sids]})
+		frappe.db.commit()
+		self.clear_buffers()
+
+	def clear_buffers(self):
+		for name in (INCOMING_MESSAGE_BUFFER, INCOMING_MESSAGE_DEAD_LETTER):
+			frappe.cache().delete_key(name)
+
+	def get_payload(self, **values):
+		message_sid = 'SM' + frappe.generate_hash(length=32)
+		self.message_sids.append(message_sid)
+		return frappe._dict({
+			'MessageSid': message_sid,
+			'From': 'whatsapp:+10000000001',
+			'To': 'whatsapp:+10000000000',
+			'Body': 'Hi',
+			'ProfileName': 'Test',
+			'SmsStatus': 'received',
+			**values
+		})
+
+	@patch('frappe.enqueue')
+	def test_flush_stores_messages_once(self, enqueue):
+		payload = self.get_payload()
+		buffer_incoming_message(payload)
+		# Replayed by Twilio before the flush
+		buffer_incoming_message(payload)
+		buffer_incoming_message(self.get_payload(SmsStatus=None))
+		self.assertEqual(enqueue.call_count, 1)
+
+		flush_incoming_messages()
+		self.assertEqual(frappe.db.count('WhatsApp Message', {'id': ['in', self.message_sids]}), 2)
+		self.assertFalse(read_buffer(INCOMING_MESSAGE_BUFFER, 10))
+
+		# Redelivered after the flush
+		buffer_incoming_message(payload)
+		flush_incoming_messages()
+		self.assertEqual(frappe.db.count('WhatsApp Message', {'id': payload.MessageSid}), 1)
+
+	@patch('frappe.enqueue')
+	def test_flush_sets_bad_payloads_aside(self, enqueue):
+		payload = self.get_payload()
+		buffer_incoming_message(self.get_payload(MessageSid=None))
+		buffer_incoming_message(payload)
+
+		flush_incoming_messages()
+		self.assertTrue(frappe.db.exists('WhatsApp Message', {'id': payload.MessageSid}))
+		self.assertFalse(read_buffer(INCOMING_MESSAGE_BUFFER, 10))
+		self.assertEqual([p['MessageSid'] for p in read_buffer(INCOMING_MESSAGE_DEAD_LETTER, 10)], [None])
+
+	def test_insert_skips_messages_stored_meanwhile(self):
+		stored, new = self.get_payload(), self.get_payload()
+		self.assertEqual(insert_incoming_messages([stored]), [])
+
+		# Stored by another flush after the lookup of stored messages
+		with patch('frappe.get_all', return_value=[]):
+			self.assertEqual(insert_incoming_messages([stored, new]), [])
+		self.assertEqual(frappe.db.count('WhatsApp Message', {'id': ['in', self.message_sids]}), 2)
@@ -6,36 +6,128 @@ from frappe.model.document import Document
 from six import string_types
 import json
 import re
+import time
+import random
 from frappe.utils.password import get_decrypted_password
-from frappe.utils import get_site_url, now_datetime, get_datetime
+from frappe.utils import get_site_url, now_datetime, get_datetime, create_batch, add_to_date, cint
+from frappe.utils.csvutils import read_csv_content
 from frappe import _
-from ...twilio_handler import Twilio
+from ...twilio_handler import Twilio, get_retry_after
+from ...rate_limiter import get_rate_governor
+from ..whatsapp_message_template.whatsapp_message_template import get_compiled_template
+from ...dispatcher import get_whatsapp_dispatcher, log_dispatch_stats, is_retryable_error
+from ...utils import bulk_update, dedupe_phone_numbers, push_to_buffer, read_buffer, trim_buffer, get_buffer_length, \
+	acquire_lock, release_lock
+
+TEMPLATE_BATCH_SIZE = 500
+SEND_RESPONSE_FIELDS = ('sent_received', 'status', 'id', 'send_on', 'retry_count', 'next_retry_at', 'last_error')
+
+# Messages that failed with a transient error wait in the outbox (status Retrying)
+# until `retry_whatsapp_messages` picks them up again.
+MAX_SEND_ATTEMPTS = 5
+RETRY_BACKOFF = 30 # seconds, doubled on every retry
+MAX_RETRY_BACKOFF = 60 * 60
+OUTBOX_BATCH_SIZE = 500
+OUTBOX_LOCK = 'whatsapp_outbox'
+# The drain stops after this long, leaving the rest to the next run.
+OUTBOX_DRAIN_SECONDS = 240
+
+STATUS_CALLBACK_BUFFER = 'whatsapp_status_callbacks'
+STATUS_CALLBACK_FLUSH_SIZE = 500
+# Buffered callbacks older than this mean the flusher is not keeping up or not running.
+STATUS_CALLBACK_STALL_SECONDS = 300
+# A flush stops after this long, well before its lock expires, and leaves the rest to the next run.
+STATUS_CALLBACK_FLUSH_SECONDS = 120
+# Callbacks can arrive before the SID of their message is written back, those are parked and retried
+# by the following flushes for this long (seconds).
+UNMATCHED_STATUS_CALLBACK_SECONDS = 60 * 60
+UNMATCHED_STATUS_CALLBACK_BUFFER = STATUS_CALLBACK_BUFFER + '_unmatched'
+
+INCOMING_MESSAGE_BUFFER = 'whatsapp_incoming_messages'
+INCOMING_MESSAGE_FLUSH_SIZE = 500
+# A flush stops after this long and leaves the rest to the next run, its lock expires after twice as long.
+INCOMING_MESSAGE_FLUSH_SECONDS = 120
+# Inbound messages that can not be stored are moved here, so that they do not hold up the buffer.
+INCOMING_MESSAGE_DEAD_LETTER = INCOMING_MESSAGE_BUFFER + '_dead_letter'
+
+# Hash of number -> unix time of its last inbound message, as plain floats
+LAST_INBOUND_INDEX = 'whatsapp_last_inbound_at'
+SESSION_WINDOW_SECONDS = 24 * 60 * 60
+
+# Position of Twilio statuses in the outgoing message lifecycle.
+# Status callbacks can arrive late or twice, a message is never moved back to a lower position.
+STATUS_LIFECYCLE = {
+	'Queued': 1,
+	'Sent': 2,
+	'Delivered': 3,
+	'Undelivered': 3,
+	'Failed': 3,
+	'Read': 4
+}
+# Twilio statuses of messages still on their way to Twilio's queue, stored as Queued.
+QUEUED_STATUSES = ('Accepted', 'Scheduled', 'Sending')
 
 class WhatsAppMessage(Document):
 	def send(self):
 		client = Twilio.get_twilio_client()
 		message_dict = self.get_message_dict()
-		response = frappe._dict()
+		governor = get_rate_governor()
+		governor.acquire(self.from_)
 
 		try:
 			response = client.messages.create(**message_dict)
-			self.sent_received = 'Sent'
-			self.status = response.status.title()
-			self.id = response.sid
-			self.send_on = response.date_sent
-			self.save(ignore_permissions=True)
-		
+			self.set_sent_response(response)
 		except Exception as e:
-			self.db_set('status', "Error")
-			error_msg = str(e)
-			
-			# Handle specific WhatsApp template errors
-			if "63016" in error_msg or "freeform message" in error_msg.lower():
-				error_msg = "Failed to send freeform message outside 24-hour window. Please use WhatsApp Template mode."
-				
-			frappe.log_error(title=_('Twilio WhatsApp Message Error'), message=error_msg)
-			frappe.msgprint(_("WhatsApp Message Error: {0}").format(error_msg), indicator="red")
-	
+			if getattr(e, 'status', None) == 429:
+				governor.throttled(self.from_, e, get_retry_after(e, client))
+			self.set_send_error(e)
+
+	def set_sent_response(self, response):
+		"""Store the Twilio response of a sent message.
+		"""
+		self.set_response_values(response)
+		self.save(ignore_permissions=True)
+
+	def set_response_values(self, response):
+		self.sent_received = 'Sent'
+		self.status = get_message_status(response.status)
+		self.id = response.sid
+		self.send_on = response.date_sent
+		self.next_retry_at = None
+
+	def set_send_error(self, error):
+		self.set_error_values(error)
+		self.db_set({field: self.get(field) for field in ('status', 'retry_count', 'next_retry_at', 'last_error')})
+		if self.status != 'Retrying':
+			self.log_send_error(error)
+
+	def set_error_values(self, error):
+		"""Put the message in the outbox for transient errors, otherwise fail it for good.
+		Messages still failing after `MAX_SEND_ATTEMPTS` are dead-lettered.
+		"""
+		self.last_error = str(error)
+		self.next_retry_at = None
+		if not is_retryable_error(error):
+			self.status = 'Error'
+			return
+
+		self.retry_count = cint(self.retry_count) + 1
+		if self.retry_count >= MAX_SEND_ATTEMPTS:
+			self.status = 'Dead Letter'
+		else:
+			self.status = 'Retrying'
+			self.next_retry_at = get_next_retry_time(self.retry_count)
+
+	def log_send_error(self, error):
+		error_msg = str(error)
+
+		# Handle specific WhatsApp template errors
+		if "63016" in error_msg or "freeform message" in error_msg.lower():
+			error_msg = "Failed to send freeform message outside 24-hour window. Please use WhatsApp Template mode."
+
+		frappe.log_error(title=_('Twilio WhatsApp Message Error'), message=error_msg)
+		frappe.msgprint(_("WhatsApp Message Error: {0}").format(error_msg), indicator="red")
+
 	def get_message_dict(self):
 		"""Build message parameters for Twilio API based on template mode"""
 		# Get the correct base URL for current environment
@@ -90,15 +182,125 @@ class WhatsAppMessage(Document):
 			if not isinstance(receiver_list, list):
 				receiver_list = [receiver_list]
 
-		for rec in receiver_list:
-			wa_message = cls.store_whatsapp_message(rec, message, doctype, docname, media, template_info)
-			wa_message.send()
+		receivers, skipped = get_unique_receivers(receiver_list)
+		wa_messages = cls.store_whatsapp_messages(
+			[number for number, receiver in receivers], message, doctype, docname, media, template_info)
+		return cls.send_messages(wa_messages)
+
+	@staticmethod
+	def send_messages(wa_messages, dispatcher=None):
+		"""Send stored messages concurrently and write the responses back with one bulk update.
+		Returns the dispatch stats of the batch.
+		"""
+		if not wa_messages:
+			return
+
+		if not dispatcher:
+			with get_whatsapp_dispatcher() as dispatcher:
+				return WhatsAppMessage.send_messages(wa_messages, dispatcher)
+
+		results, stats = dispatcher.dispatch([(msg, msg.get_message_dict()) for msg in wa_messages])
+		updates = {}
+		for result in results:
+			wa_message = result.key
+			if result.error:
+				wa_message.set_error_values(result.error)
+				if wa_message.status == 'Retrying':
+					stats.retrying += 1
+				else:
+					wa_message.log_send_error(result.error)
+			else:
+				wa_message.set_response_values(result.response)
+			updates[wa_message.name] = {field: wa_message.get(field) for field in SEND_RESPONSE_FIELDS}
+
+		bulk_update('WhatsApp Message', updates)
+		log_dispatch_stats(stats)
+		return stats
 
 	@staticmethod
 	def store_whatsapp_message(to, message, doctype=None, docname=None, media=None, template_info=None):
 		"""Store WhatsApp message with template support"""
 		sender = frappe.db.get_single_value('Twilio Settings', 'whatsapp_no')
-		
+		message_doc = WhatsAppMessage.get_outgoing_message_dict(sender, to, message, doctype, docname, media, template_info)
+
+		wa_msg = frappe.get_doc(message_doc).insert(ignore_permissions=True)
+		return wa_msg
+
+	@staticmethod
+	def store_whatsapp_messages(receiver_list, message, doctype=None, docname=None, media=None, template_info=None):
+		"""Store one message per receiver with a single multi-row insert.
+		The sender and field defaults are resolved once for the whole batch.
+		Returns the stored messages as documents.
+		"""
+		if not receiver_list:
+			return []
+
+		sender = frappe.db.get_single_value('Twilio Settings', 'whatsapp_no')
+		return WhatsAppMessage.insert_messages([
+			WhatsAppMessage.get_outgoing_message_dict(sender, to, message, doctype, docname, media, template_info)
+			for to in receiver_list
+		])
+
+	@staticmethod
+	def insert_messages(message_dicts):
+		"""Insert messages with a single multi-row insert and return them as documents.
+		"""
+		now = now_datetime()
+		wa_messages = []
+		for message_dict in message_dicts:
+			wa_message = frappe.new_doc('WhatsApp Message')
+			wa_message.update(message_dict)
+			wa_message.update({
+				'name': frappe.generate_hash(length=10),
+				'owner': frappe.session.user,
+				'modified_by': frappe.session.user,
+				'creation': now,
+				'modified': now
+			})
+			wa_messages.append(wa_message)
+
+		rows = [wa_message.get_valid_dict(convert_dates_to_str=True) for wa_message in wa_messages]
+		fields = list(rows[0])
+		frappe.db.bulk_insert('WhatsApp Message', fields, [[row.get(field) for field in fields] for row in rows])
+		return wa_messages
+
+	@classmethod
+	def send_template_messages(cls, template_name, rows, recipient_field='whatsapp_no', field_map=None,
+			doctype=None, docname=None):
+		"""Send a template to every row, binding its variables from the row's own fields.
+		Rows are bound, stored and dispatched in batches with one commit per batch.
+		Messages left in the outbox for a retry are reported as `retrying`, not as failed.
+		"""
+		template = get_compiled_template(template_name)
+		if not template.content_sid:
+			frappe.throw(_("Template {0} does not have a Content SID").format(template_name))
+
+		sender = frappe.db.get_single_value('Twilio Settings', 'whatsapp_no')
+		receivers, skipped = get_unique_receivers(rows, get_number=lambda row: row.get(recipient_field))
+		sent = failed = retrying = 0
+
+		with get_whatsapp_dispatcher() as dispatcher:
+			for batch in create_batch(receivers, TEMPLATE_BATCH_SIZE):
+				bound_rows = template.bind_rows([row for number, row in batch], field_map)
+				wa_messages = cls.insert_messages([
+					cls.get_outgoing_message_dict(sender, number, message, doctype, docname,
+						template_info={
+							'template_name': template.name,
+							'content_sid': template.content_sid,
+							'content_variables': content_variables
+						})
+					for (number, row), (message, content_variables) in zip(batch, bound_rows)
+				])
+				stats = cls.send_messages(wa_messages, dispatcher)
+				sent += stats.sent
+				failed += stats.failed - stats.retrying
+				retrying += stats.retrying
+				frappe.db.commit()
+
+		return {'sent': sent, 'failed': failed, 'retrying': retrying, **skipped}
+
+	@staticmethod
+	def get_outgoing_message_dict(sender, to, message, doctype=None, docname=None, media=None, template_info=None):
 		message_doc = {
 			'doctype': 'WhatsApp Message',
 			'type': 'Outgoing',
@@ -112,39 +314,32 @@ class WhatsAppMessage(Document):
 			'content_type': 'text',
 			'message_type': 'Text'
 		}
-		
+
 		# Add template information if provided
 		if template_info:
+			content_variables = template_info.get('content_variables')
 			message_doc.update({
 				'template_mode': 1,
 				'whatsapp_template': template_info.get('template_name'),
 				'content_sid': template_info.get('content_sid'),
-				'content_variables': template_info.get('content_variables')
+				'content_variables': frappe.as_json(content_variables) if isinstance(content_variables, dict) else content_variables
 			})
-		
-		wa_msg = frappe.get_doc(message_doc).insert(ignore_permissions=True)
-		return wa_msg
+		return message_doc
 
 	@staticmethod
 	def is_in_session_window(to_number):
 		"""Check if recipient is within 24-hour session window"""
-		# Get last received message from this number
-		last_received = frappe.db.sql("""
-			SELECT send_on FROM `tabWhatsApp Message`
-			WHERE from_ = %s AND sent_received = 'Received'
-			ORDER BY send_on DESC LIMIT 1
-		""", (to_number,), as_dict=True)
-		
-		if not last_received:
-			return False
-			
-		# Check if within 24 hours
-		last_message_time = get_datetime(last_received[0].send_on)
-		current_time = now_datetime()
-		time_diff = current_time - last_message_time
-		
-		# Return True if within 24 hours (86400 seconds)
-		return time_diff.total_seconds() <= 86400
+		return WhatsAppMessage.get_session_window_status([to_number])[to_number]
+
+	@staticmethod
+	def get_session_window_status(numbers):
+		"""Check a list of recipients against the 24-hour session window in one lookup.
+		>>> WhatsAppMessage.get_session_window_status(['whatsapp:+11234567890', 'whatsapp:+10987654321'])
+		{'whatsapp:+11234567890': True, 'whatsapp:+10987654321': False}
+		"""
+		window_start = now_datetime().timestamp() - SESSION_WINDOW_SECONDS
+		last_inbound = get_last_inbound_times(numbers)
+		return {number: last_inbound.get(number, 0) >= window_start for number in numbers}
 	
 	@staticmethod
 	def extract_variables_from_message(message_text):
@@ -158,19 +353,366 @@ class WhatsAppMessage(Document):
 		
 		return {var.strip(): f"[{var.strip()}]" for var in variables}
 
-def incoming_message_callback(args):
-	wa_msg = frappe.get_doc({
-			'doctype': 'WhatsApp Message',
-			'type': 'Incoming',
-			'from_': args.From,
-			'to': args.To,
-			'message': args.Body,
-			'profile_name': args.ProfileName,
-			'sent_received': args.SmsStatus.title(),
-			'id': args.MessageSid,
-			'send_on': frappe.utils.now(),
-			'status': 'Received',
-			'content_type': 'text',
-			'message_type': 'Text',
-			'message_id': args.MessageSid
-		}).insert(ignore_permissions=True)
\ No newline at end of file
+def get_incoming_message_dict(args):
+	return {
+		'doctype': 'WhatsApp Message',
+		'type': 'Incoming',
+		'from_': args.From,
+		'to': args.To,
+		'message': args.Body,
+		'profile_name': args.ProfileName,
+		'sent_received': (args.SmsStatus or '').title(),
+		'id': args.MessageSid,
+		'send_on': args.send_on or frappe.utils.now(),
+		'status': 'Received',
+		'content_type': 'text',
+		'message_type': 'Text',
+		'message_id': args.MessageSid
+	}
+
+def buffer_incoming_message(args):
+	"""Keep an inbound message for `flush_incoming_messages`, which stores it with others in one batch.
+	The session window of the sender is opened right away, replies must not wait for the flush.
+	"""
+	send_on = frappe.utils.now()
+	if (args.SmsStatus or '').title() == 'Received':
+		set_last_inbound_time(args.From, get_datetime(send_on).timestamp())
+
+	if push_to_buffer(INCOMING_MESSAGE_BUFFER, {**args, 'send_on': send_on}) == 1:
+		# First message into an empty buffer, the ones that follow are drained by the same flush
+		frappe.enqueue(
+			'twilio_integration.twilio_integration.doctype.whatsapp_message.whatsapp_message.flush_incoming_messages',
+			queue='short'
+		)
+
+def flush_incoming_messages():
+	"""Store buffered inbound messages in batches, one transaction per batch.
+	As with status callbacks, a batch is trimmed only after it is committed.
+	Replayed or redelivered messages are skipped by `insert_incoming_messages`,
+	messages that can not be stored are set aside in `INCOMING_MESSAGE_DEAD_LETTER`.
+	"""
+	lock = INCOMING_MESSAGE_BUFFER + '_flush_lock'
+	lock_token = acquire_lock(lock, timeout=INCOMING_MESSAGE_FLUSH_SECONDS * 2)
+	if not lock_token:
+		return
+
+	try:
+		deadline = time.monotonic() + INCOMING_MESSAGE_FLUSH_SECONDS
+		while time.monotonic() < deadline:
+			payloads = read_buffer(INCOMING_MESSAGE_BUFFER, INCOMING_MESSAGE_FLUSH_SIZE)
+			if not payloads:
+				break
+
+			rejected = insert_incoming_messages(payloads)
+			frappe.db.commit()
+
+			set_aside_incoming_messages(rejected)
+			trim_buffer(INCOMING_MESSAGE_BUFFER, len(payloads))
+	finally:
+		release_lock(lock, lock_token)
+
+def insert_incoming_messages(payloads):
+	"""Insert inbound messages with one multi-row insert, once per MessageSid.
+	Messages that are already stored are skipped.
+	Returns the payloads that could not be stored, along with the reason.
+	"""
+	rejected = [(payload, 'Missing MessageSid') for payload in payloads if not payload.get('MessageSid')]
+	messages = {payload['MessageSid']: frappe._dict(payload) for payload in payloads if payload.get('MessageSid')}
+	if not messages:
+		return rejected
+
+	stored = set(frappe.get_all('WhatsApp Message', filters={'id': ['in', list(messages)]}, pluck='id'))
+	message_dicts = {}
+	for message_sid, args in messages.items():
+		if message_sid in stored:
+			continue
+		try:
+			message_dicts[message_sid] = get_incoming_message_dict(args)
+		except Exception:
+			rejected.append((args, frappe.get_traceback()))
+	if not message_dicts:
+		return rejected
+
+	# Savepoints undo a failed insert without aborting the rest of the transaction, on Postgres as well
+	frappe.db.savepoint('incoming_messages')
+	try:
+		WhatsAppMessage.insert_messages(list(message_dicts.values()))
+	except Exception:
+		# Some were stored in the meantime or do not fit the table, insert them one by one
+		frappe.db.rollback(save_point='incoming_messages')
+		for message_sid, message_dict in message_dicts.items():
+			frappe.db.savepoint('incoming_message')
+			try:
+				WhatsAppMessage.insert_messages([message_dict])
+			except Exception as e:
+				frappe.db.rollback(save_point='incoming_message')
+				if not frappe.db.is_duplicate_entry(e):
+					rejected.append((messages[message_sid], frappe.get_traceback()))
+	return rejected
+
+def set_aside_incoming_messages(rejected):
+	"""Move rejected inbound messages to the dead letter list and log why they were rejected.
+	"""
+	if not rejected:
+		return
+
+	for payload, reason in rejected:
+		push_to_buffer(INCOMING_MESSAGE_DEAD_LETTER, payload)
+	frappe.log_error(
+		title=_("WhatsApp Incoming Message Error"),
+		message='\n\n'.join('{}\n{}'.format(frappe.as_json(payload, indent=None), reason) for payload, reason in rejected)
+	)
+
+def set_last_inbound_time(number, timestamp):
+	cache = frappe.cache()
+	cache.pipeline(transaction=False).hset(cache.make_key(LAST_INBOUND_INDEX), number, timestamp).execute()
+
+def get_last_inbound_times(numbers):
+	"""Time of the last inbound message per number as a unix timestamp, 0 if the number never wrote to us.
+	Served from a redis hash kept current by `buffer_incoming_message`,
+	numbers missing from it are loaded with one grouped query and added to it.
+	"""
+	numbers = list(set(numbers))
+	if not numbers:
+		return {}
+
+	cache = frappe.cache()
+	key = cache.make_key(LAST_INBOUND_INDEX)
+	values = cache.hmget(key, numbers)
+	last_inbound = {number: float(value) for number, value in zip(numbers, values) if value is not None}
+
+	missing = [number for number in numbers if number not in last_inbound]
+	if missing:
+		rows = frappe.db.sql("""
+			SELECT from_, MAX(send_on) FROM `tabWhatsApp Message`
+			WHERE from_ IN %(numbers)s AND sent_received = 'Received'
+			GROUP BY from_
+		""", {'numbers': missing})
+		found = {number: get_datetime(send_on).timestamp() for number, send_on in rows if send_on}
+		pipeline = cache.pipeline(transaction=False)
+		for number in missing:
+			last_inbound[number] = found.get(number, 0)
+			# A message received meanwhile has already set a newer time
+			pipeline.hsetnx(key, number, last_inbound[number])
+		pipeline.execute()
+
+	return last_inbound
+
+def get_message_status(twilio_status):
+	"""Status option of a Twilio message status.
+	>>> get_message_status('sending')
+	'Queued'
+	"""
+	status = (twilio_status or '').title()
+	return 'Queued' if status in QUEUED_STATUSES else status
+
+def update_message_status(message_sid, status):
+	"""Move a sent message forward in its lifecycle with a single conditional UPDATE keyed on the Twilio SID.
+	Returns False if the message is unknown or already at or past `status`.
+	"""
+	position = STATUS_LIFECYCLE.get(status)
+	if not (message_sid and position):
+		return False
+
+	# Messages that errored on send can still be reported by Twilio
+	earlier_statuses = tuple(['Error', ''] + [s for s, p in STATUS_LIFECYCLE.items() if p < position])
+	modified = now_datetime()
+	frappe.db.sql("""
+		UPDATE `tabWhatsApp Message`
+		SET `status` = %(status)s, `modified` = %(modified)s
+		WHERE `id` = %(message_sid)s AND (`status` IS NULL OR `status` IN %(earlier_statuses)s)
+		""", {
+			'status': status,
+			'modified': modified,
+			'message_sid': message_sid,
+			'earlier_statuses': earlier_statuses
+		})
+
+	# The affected row count is not exposed by frappe.db. The UPDATE keeps the row locked until the caller
+	# commits, so the row carries this update's `modified` only if the UPDATE changed it.
+	message = frappe.db.get_value('WhatsApp Message', {'id': message_sid}, ['status', 'modified'], as_dict=True)
+	return bool(message) and message.status == status and get_datetime(message.modified) == modified
+
+def process_status_callback(args):
+	"""Apply a status callback payload. The caller commits.
+	Returns False if the callback was out of order or repeated, or its message is unknown.
+	"""
+	new_status = get_message_status(args.MessageStatus)
+
+	# Out of order and repeated callbacks leave the message untouched
+	if not update_message_status(args.MessageSid, new_status):
+		return False
+
+	# Log template-related errors specifically
+	if new_status == 'Failed' and args.ErrorCode:
+		error_details = f"Error Code: {args.ErrorCode}"
+		if args.ErrorMessage:
+			error_details += f", Message: {args.ErrorMessage}"
+
+		# Check for template-specific errors
+		if args.ErrorCode == '63016':
+			error_details += " - This error occurs when sending freeform messages outside the 24-hour window. Use WhatsApp Template mode instead."
+
+		frappe.log_error(
+			title=f"WhatsApp Message Failed - {args.MessageSid}",
+			message=error_details
+		)
+	return True
+
+def buffer_status_callback(args):
+	push_to_buffer(STATUS_CALLBACK_BUFFER, {**args, 'received_at': time.time()})
+
+def flush_status_callbacks():
+	"""Apply buffered status callbacks in batches, one transaction per batch.
+	Callbacks are trimmed from the buffer only after their batch is committed,
+	a crash in between replays them and the conditional update skips the ones already applied.
+	"""
+	lock = STATUS_CALLBACK_BUFFER + '_flush_lock'
+	lock_token = acquire_lock(lock, timeout=STATUS_CALLBACK_STALL_SECONDS)
+	if not lock_token:
+		return
+
+	try:
+		deadline = time.monotonic() + STATUS_CALLBACK_FLUSH_SECONDS
+		requeue_unmatched_status_callbacks()
+		while time.monotonic() < deadline:
+			callbacks = read_buffer(STATUS_CALLBACK_BUFFER, STATUS_CALLBACK_FLUSH_SIZE)
+			if not callbacks:
+				break
+
+			unapplied = []
+			for callback in callbacks:
+				try:
+					if not process_status_callback(frappe._dict(callback)):
+						unapplied.append(callback)
+				except Exception:
+					frappe.log_error(title="WhatsApp Status Callback Error", message=frappe.get_traceback())
+			frappe.db.commit()
+
+			park_unmatched_status_callbacks(unapplied)
+			trim_buffer(STATUS_CALLBACK_BUFFER, len(callbacks))
+			frappe.cache().set_value(STATUS_CALLBACK_BUFFER + '_last_flush', time.time())
+	finally:
+		release_lock(lock, lock_token)
+
+def park_unmatched_status_callbacks(callbacks):
+	"""Set aside callbacks for messages that are not stored with their SID yet.
+	SIDs are written back once the whole dispatch batch of a message is sent, its first callbacks can arrive earlier.
+	Callbacks still unmatched after `UNMATCHED_STATUS_CALLBACK_SECONDS` are dropped.
+	"""
+	message_sids = list({callback.get('MessageSid') for callback in callbacks if callback.get('MessageSid')})
+	if not message_sids:
+		return
+
+	stored = set(frappe.get_all('WhatsApp Message', filters={'id': ['in', message_sids]}, pluck='id'))
+	expired_before = time.time() - UNMATCHED_STATUS_CALLBACK_SECONDS
+	for callback in callbacks:
+		if not callback.get('MessageSid') or callback['MessageSid'] in stored:
+			# Out of order or repeated
+			continue
+		if callback.setdefault('received_at', time.time()) < expired_before:
+			frappe.logger('twilio_integration').warning(
+				'Dropped status callback of unknown WhatsApp message: {}'.format(callback))
+			continue
+		push_to_buffer(UNMATCHED_STATUS_CALLBACK_BUFFER, callback)
+
+def requeue_unmatched_status_callbacks():
+	"""Move parked callbacks back into the buffer, so that each flush retries them once.
+	"""
+	size = get_buffer_length(UNMATCHED_STATUS_CALLBACK_BUFFER)
+	if not size:
+		return
+
+	for callback in read_buffer(UNMATCHED_STATUS_CALLBACK_BUFFER, size):
+		push_to_buffer(STATUS_CALLBACK_BUFFER, callback)
+	trim_buffer(UNMATCHED_STATUS_CALLBACK_BUFFER, size)
+
+def get_status_callback_buffer_metrics():
+	"""Backlog of the status callback buffer. `stalled` is set when the oldest callback has waited too long.
+	"""
+	backlog = get_buffer_length(STATUS_CALLBACK_BUFFER)
+	oldest = backlog and read_buffer(STATUS_CALLBACK_BUFFER, 1)
+	oldest_age = oldest and time.time() - oldest[0].get('received_at', time.time()) or 0
+	return {
+		'backlog': backlog,
+		'unmatched': get_buffer_length(UNMATCHED_STATUS_CALLBACK_BUFFER),
+		'oldest_age': round(oldest_age, 1),
+		'last_flush': frappe.cache().get_value(STATUS_CALLBACK_BUFFER + '_last_flush'),
+		'stalled': oldest_age > STATUS_CALLBACK_STALL_SECONDS
+	}
+
+def get_next_retry_time(retry_count):
+	"""Exponential backoff with jitter, so that messages failed together are not retried together.
+	"""
+	delay = min(RETRY_BACKOFF * 2 ** (retry_count - 1), MAX_RETRY_BACKOFF)
+	return add_to_date(now_datetime(), seconds=delay * random.uniform(0.5, 1))
+
+def retry_whatsapp_messages():
+	"""Drain the outbox, sending messages whose retry is due in batches, oldest first.
+	"""
+	if not frappe.get_cached_doc('Twilio Settings').enabled:
+		return
+	lock_token = acquire_lock(OUTBOX_LOCK, OUTBOX_DRAIN_SECONDS * 2)
+	if not lock_token:
+		return
+
+	try:
+		deadline = time.monotonic() + OUTBOX_DRAIN_SECONDS
+		with get_whatsapp_dispatcher() as dispatcher:
+			while time.monotonic() < deadline:
+				wa_messages = [frappe.get_doc(dict(row, doctype='WhatsApp Message')) for row in frappe.get_all(
+					'WhatsApp Message',
+					filters={'status': 'Retrying', 'next_retry_at': ['<=', now_datetime()]},
+					fields=['*'],
+					order_by='next_retry_at',
+					limit=OUTBOX_BATCH_SIZE
+				)]
+				if not wa_messages:
+					break
+				WhatsAppMessage.send_messages(wa_messages, dispatcher)
+				update_campaign_counts(wa_messages)
+				frappe.db.commit()
+	finally:
+		release_lock(OUTBOX_LOCK, lock_token)
+
+def update_campaign_counts(wa_messages):
+	"""Count campaign messages that left the outbox, sent or failed for good, against their campaign.
+	"""
+	from twilio_integration.twilio_integration.doctype.whatsapp_campaign.whatsapp_campaign import count_outbox_messages
+
+	counts = {}
+	for wa_message in wa_messages:
+		if wa_message.reference_doctype != 'WhatsApp Campaign' or wa_message.status == 'Retrying':
+			continue
+		count = counts.setdefault(wa_message.reference_document_name, {'sent': 0, 'failed': 0})
+		count['failed' if wa_message.status in ('Error', 'Dead Letter') else 'sent'] += 1
+
+	for campaign, count in counts.items():
+		count_outbox_messages(campaign, **count)
+
+def get_unique_receivers(items, get_number=None):
+	"""Normalize receivers to E.164 and drop duplicate and invalid numbers before they cost a send.
+	"""
+	default_country_code = frappe.get_cached_doc('Twilio Settings').default_country_code
+	receivers, skipped = dedupe_phone_numbers(items, default_country_code, get_number)
+	if skipped['duplicates'] or skipped['invalid']:
+		frappe.logger('twilio_integration').info('WhatsApp sends saved by deduplication: {}'.format(skipped))
+	return receivers, skipped
+
+def send_template_batch(template_name, field_map=None, doctype=None, filters=None, csv_file=None,
+		recipient_field='whatsapp_no'):
+	"""Send a personalized template to the records of `doctype` matching `filters`,
+	or to the rows of an uploaded CSV file whose first row holds the column names.
+	"""
+	field_map = frappe.parse_json(field_map) or {}
+
+	if csv_file:
+		file_doc = frappe.get_doc('File', {'file_url': csv_file})
+		header, *data = read_csv_content(file_doc.get_content())
+		rows = [dict(zip(header, values)) for values in data]
+	else:
+		template = get_compiled_template(template_name)
+		fields = {recipient_field, *template.source_fields.values(), *field_map.values()}
+		rows = frappe.get_all(doctype, filters=frappe.parse_json(filters), fields=list(fields))
+
+	return WhatsAppMessage.send_template_messages(template_name, rows, recipient_field, field_map, doctype=doctype)
@@ -5,12 +5,29 @@ import re
 import frappe
 from frappe.model.document import Document
 from frappe import _
+from frappe.utils import cstr
+
+VARIABLE_PATTERN = re.compile(r'\{\{(\d+)\}\}')
+TEMPLATE_VERSIONS = 'whatsapp_template_versions'
+
+# Per worker registry of compiled templates keyed by (site, template name),
+# validated against the version published in redis on save.
+_compiled_templates = {}
 
 class WhatsAppMessageTemplate(Document):
 	def validate(self):
 		self.validate_content_sid()
-		self.extract_variables_from_message()
-	
+		if self.is_new() or self.has_value_changed('message') or not self.template_variables:
+			self.extract_variables_from_message()
+
+	def on_update(self):
+		frappe.cache().hset(TEMPLATE_VERSIONS, self.name, str(self.modified))
+		_compiled_templates.pop((frappe.local.site, self.name), None)
+
+	def on_trash(self):
+		frappe.cache().hdel(TEMPLATE_VERSIONS, self.name)
+		_compiled_templates.pop((frappe.local.site, self.name), None)
+
 	def validate_content_sid(self):
 		"""Validate that Content SID is provided for approved templates"""
 		if self.template_status == "Approved" and not self.content_sid:
@@ -22,19 +39,22 @@ class WhatsAppMessageTemplate(Document):
 			return
 		
 		# Find all {{number}} patterns in message
-		variable_pattern = r'\{\{(\d+)\}\}'
-		variables = re.findall(variable_pattern, self.message)
+		variables = VARIABLE_PATTERN.findall(self.message)
 		
 		if variables:
-			# Clear existing variables
+			# Keep names and defaults of variables that are still in the message
+			existing = {cstr(v.variable_position): v for v in self.template_variables}
 			self.template_variables = []
 			
 			# Add found variables
 			for var in sorted(set(variables), key=int):
+				previous = existing.get(var)
 				self.append('template_variables', {
-					'variable_name': f'Variable {var}',
+					'variable_name': previous.variable_name if previous else f'Variable {var}',
 					'variable_position': int(var),
-					'variable_type': 'TEXT'
+					'variable_type': previous.variable_type if previous else 'TEXT',
+					'default_value': previous.default_value if previous else None,
+					'source_field': previous.source_field if previous else None
 				})
 	
 	def get_content_variables(self, variable_values):
@@ -47,20 +67,90 @@ class WhatsAppMessageTemplate(Document):
 		Returns:
 			Dict formatted for Twilio ContentVariables parameter
 		"""
+		return CompiledTemplate(self).get_content_variables(variable_values)
+
+
+class CompiledTemplate:
+	"""Read-only form of a template with its variable positions resolved,
+	so that content variables are rendered without any database access.
+	"""
+	def __init__(self, doc):
+		self.name = doc.name
+		self.version = str(doc.modified)
+		self.template_name = doc.template_name
+		self.template_status = doc.template_status
+		self.content_sid = doc.content_sid
+		self.message = doc.message
+		# (position, name, default) of each variable
+		self.variables = [
+			(str(v.variable_position), v.variable_name, v.default_value)
+			for v in doc.template_variables
+		]
+		self.source_fields = {
+			str(v.variable_position): v.source_field
+			for v in doc.template_variables if v.source_field
+		}
+		# Message split around its variables, odd items are variable positions
+		self.message_parts = VARIABLE_PATTERN.split(self.message or '')
+
+	def get_content_variables(self, variable_values):
+		"""Same as `WhatsAppMessageTemplate.get_content_variables`.
+		"""
 		content_variables = {}
-		
-		for variable in self.template_variables:
-			var_key = str(variable.variable_position)
-			
+
+		for position, name, default_value in self.variables:
 			# Try to get value from variable_values dict
-			if variable.variable_name in variable_values:
-				content_variables[var_key] = variable_values[variable.variable_name]
-			elif f'Variable {var_key}' in variable_values:
-				content_variables[var_key] = variable_values[f'Variable {var_key}']
-			elif variable.default_value:
-				content_variables[var_key] = variable.default_value
+			if name in variable_values:
+				content_variables[position] = variable_values[name]
+			elif f'Variable {position}' in variable_values:
+				content_variables[position] = variable_values[f'Variable {position}']
+			elif default_value:
+				content_variables[position] = default_value
 			else:
 				# Use placeholder if no value provided
-				content_variables[var_key] = f"[{variable.variable_name}]"
-		
+				content_variables[position] = f"[{name}]"
+
 		return content_variables
+
+	def bind_rows(self, rows, field_map=None):
+		"""Bind the variables of every row from its fields in one pass.
+		`field_map` ({position: fieldname}) overrides the Source Field of the template variables.
+		Returns a list of (message, content_variables) pairs, in the order of `rows`.
+		>>> template.bind_rows([{'first_name': 'Jane'}], {'1': 'first_name'})
+		[('Hi Jane', {'1': 'Jane'})]
+		"""
+		source_fields = {**self.source_fields, **{str(k): v for k, v in (field_map or {}).items()}}
+		binders = [
+			(position, source_fields.get(position), default_value or f"[{name}]")
+			for position, name, default_value in self.variables
+		]
+		parts = self.message_parts
+
+		bound = []
+		for row in rows:
+			content_variables = {
+				position: cstr(row.get(fieldname) if fieldname else None) or fallback
+				for position, fieldname, fallback in binders
+			}
+			message = ''.join(
+				content_variables.get(part, '{{%s}}' % part) if i % 2 else part
+				for i, part in enumerate(parts)
+			)
+			bound.append((message, content_variables))
+		return bound
+
+
+def get_compiled_template(name):
+	"""Get a template from the registry of this worker, compiling it on first use or after it is saved.
+	"""
+	version = frappe.cache().hget(TEMPLATE_VERSIONS, name)
+	key = (frappe.local.site, name)
+	compiled = _compiled_templates.get(key)
+	if compiled and compiled.version == version:
+		return compiled
+
+	compiled = CompiledTemplate(frappe.get_cached_doc('WhatsApp Message Template', name))
+	_compiled_templates[key] = compiled
+	if compiled.version != version:
+		frappe.cache().hset(TEMPLATE_VERSIONS, name, compiled.version)
+	return compiled
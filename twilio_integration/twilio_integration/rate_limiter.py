@@ -0,0 +1,130 @@
+"""Send rate governor shared by every worker through redis.
+
+Each bucket learns its rate AIMD style: every granted message raises the rate a little,
+a 429 halves it and blocks the bucket for as long as Twilio's `Retry-After` asks.
+Messages take a token from the account bucket and from the bucket of their sender,
+so every sender runs at its own throughput tier within the account's limits.
+"""
+import time
+
+import frappe
+from frappe.utils import flt
+
+DEFAULT_MESSAGES_PER_SECOND = 1
+MIN_MESSAGES_PER_SECOND = 0.5
+# Rate gained per granted message is INCREASE_STEP / rate, about INCREASE_STEP messages per second, every second.
+INCREASE_STEP = 1.0
+# Concurrent 429s of one burst only halve the rate once.
+DECREASE_INTERVAL = 1
+# The account's limit is not known up front, its bucket only slows down on account level 429s.
+ACCOUNT_MAX_MESSAGES_PER_SECOND = 1e6
+# Idle buckets are forgotten and start over from the configured rate.
+BUCKET_EXPIRY = 24 * 60 * 60
+MAX_WAIT = 1 # seconds slept between acquire attempts
+
+# Sender throughput exceeded, every other 429 is counted against the account.
+SENDER_THROTTLE_ERROR_CODES = {63018}
+
+ACQUIRE_SCRIPT = """
+local now, default_rate = tonumber(ARGV[1]), tonumber(ARGV[2])
+local increase, expiry = tonumber(ARGV[3]), tonumber(ARGV[4])
+local buckets, wait = {}, 0
+for i, key in ipairs(KEYS) do
+	local state = redis.call('HMGET', key, 'rate', 'tokens', 'updated_at', 'blocked_until')
+	local rate = tonumber(state[1]) or default_rate
+	local tokens = tonumber(state[2]) or rate
+	local updated_at = tonumber(state[3]) or now
+	local blocked_until = tonumber(state[4]) or 0
+	tokens = math.min(rate, tokens + math.max(now - updated_at, 0) * rate)
+	wait = math.max(wait, blocked_until - now)
+	if tokens < 1 then
+		wait = math.max(wait, (1 - tokens) / rate)
+	end
+	buckets[i] = {rate, tokens}
+end
+for i, key in ipairs(KEYS) do
+	local rate, tokens = buckets[i][1], buckets[i][2]
+	if wait <= 0 then
+		tokens = tokens - 1
+		rate = math.min(tonumber(ARGV[4 + i]), rate + increase / rate)
+	end
+	redis.call('HSET', key, 'rate', tostring(rate), 'tokens', tostring(tokens), 'updated_at', tostring(now))
+	redis.call('EXPIRE', key, expiry)
+end
+return tostring(wait)
+"""
+
+THROTTLE_SCRIPT = """
+local now, retry_after, min_rate = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local default_rate, decrease_interval, expiry = tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[6])
+local state = redis.call('HMGET', KEYS[1], 'rate', 'decreased_at', 'blocked_until')
+local rate = tonumber(state[1]) or default_rate
+if now - (tonumber(state[2]) or 0) >= decrease_interval then
+	rate = math.max(min_rate, rate / 2)
+	redis.call('HSET', KEYS[1], 'decreased_at', tostring(now))
+end
+local blocked_until = math.max(tonumber(state[3]) or 0, now + retry_after)
+redis.call('HSET', KEYS[1], 'rate', tostring(rate), 'tokens', '0', 'updated_at', tostring(now),
+	'blocked_until', tostring(blocked_until))
+redis.call('EXPIRE', KEYS[1], expiry)
+return tostring(rate)
+"""
+
+
+class RateGovernor:
+	"""Paces WhatsApp sends across workers, learning the highest rate Twilio accepts.
+	>>> governor = get_rate_governor()
+	>>> governor.acquire('whatsapp:+14155238886') # blocks until the account and the sender have a token
+	>>> governor.throttled('whatsapp:+14155238886', error, retry_after=2)
+	"""
+	def __init__(self, account_sid, rate=DEFAULT_MESSAGES_PER_SECOND, max_rate=None):
+		self.account_sid = account_sid
+		self.rate = flt(rate) or DEFAULT_MESSAGES_PER_SECOND
+		self.max_rate = max(flt(max_rate), self.rate)
+		self.cache = frappe.cache()
+		# Dispatchers call the governor from worker threads, where `make_key` has no site to prefix
+		self.key_prefix = frappe.safe_decode(self.cache.make_key('twilio_rate::{}::'.format(account_sid)))
+		self.acquire_script = self.cache.register_script(ACQUIRE_SCRIPT)
+		self.throttle_script = self.cache.register_script(THROTTLE_SCRIPT)
+
+	def get_key(self, sender=None):
+		return self.key_prefix + (sender or '')
+
+	def acquire(self, sender=None):
+		"""Take a token from the account bucket and the bucket of `sender`, sleeping until both have one.
+		"""
+		keys, max_rates = [self.get_key()], [ACCOUNT_MAX_MESSAGES_PER_SECOND]
+		if sender:
+			keys.append(self.get_key(sender))
+			max_rates.append(self.max_rate)
+
+		while True:
+			wait = flt(self.acquire_script(keys=keys,
+				args=[time.time(), self.rate, INCREASE_STEP, BUCKET_EXPIRY, *max_rates]))
+			if wait <= 0:
+				return
+			time.sleep(min(wait, MAX_WAIT))
+
+	def throttled(self, sender=None, error=None, retry_after=0):
+		"""Back off the bucket Twilio throttled: the sender's for sender rate errors, otherwise the account's.
+		"""
+		code = getattr(error, 'code', None)
+		key = self.get_key(sender) if sender and code in SENDER_THROTTLE_ERROR_CODES else self.get_key()
+		self.throttle_script(keys=[key], args=[time.time(), flt(retry_after), MIN_MESSAGES_PER_SECOND,
+			self.rate, DECREASE_INTERVAL, BUCKET_EXPIRY])
+
+	def get_rates(self, senders=()):
+		"""Current learned rate of the account and of each given sender.
+		"""
+		pipeline = self.cache.pipeline(transaction=False)
+		for sender in (None, *senders):
+			pipeline.hget(self.get_key(sender), 'rate')
+		return dict(zip(('account', *senders), [flt(rate) or self.rate for rate in pipeline.execute()]))
+
+
+def get_rate_governor():
+	"""Governor of the configured account, starting from and capped by the rates in `Twilio Settings`.
+	"""
+	settings = frappe.get_cached_doc('Twilio Settings')
+	return RateGovernor(settings.account_sid, rate=settings.whatsapp_messages_per_second,
+		max_rate=settings.whatsapp_max_messages_per_second)
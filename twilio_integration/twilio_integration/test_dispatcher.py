@@ -0,0 +1,127 @@
+# Copyright (c) 2026, Frappe and Contributors
+# See license.txt
+
+import json
+import threading
+import importlib.util
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from twilio.rest import Client as TwilioClient
+from twilio.base.exceptions import TwilioRestException
+import frappe
+from twilio_integration.twilio_integration.dispatcher import WhatsAppDispatcher, AsyncWhatsAppDispatcher, \
+	is_retryable_error
+from twilio_integration.twilio_integration.rate_limiter import RateGovernor
+
+
+class FakeTwilioHandler(BaseHTTPRequestHandler):
+	"""Answers `messages.create` like api.twilio.com, throttling the first `throttle` requests.
+	"""
+	def do_POST(self):
+		self.rfile.read(int(self.headers['Content-Length']))
+		with self.server.lock:
+			self.server.requests += 1
+			throttled = self.server.requests <= self.server.throttle
+
+		if throttled:
+			self.reply(429, {'code': 20429, 'message': 'Too Many Requests', 'status': 429})
+		else:
+			self.reply(201, {'sid': 'SM{:032d}'.format(self.server.requests), 'status': 'queued', 'date_sent': None})
+
+	def reply(self, status, body):
+		payload = json.dumps(body).encode()
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(payload)))
+		self.end_headers()
+		self.wfile.write(payload)
+
+	def log_message(self, *args):
+		pass
+
+
+class FakeTwilioServer(ThreadingHTTPServer):
+	# Room for the burst of connections opened by the async dispatcher
+	request_queue_size = 512
+
+
+class TestWhatsAppDispatcher(unittest.TestCase):
+	dispatcher_class = WhatsAppDispatcher
+
+	def setUp(self):
+		self.server = FakeTwilioServer(('127.0.0.1', 0), FakeTwilioHandler)
+		self.server.lock = threading.Lock()
+		self.server.requests = 0
+		self.server.throttle = 0
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+		self.client = TwilioClient('AC' + '0' * 32, 'token')
+		self.client.api.base_url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+	def get_messages(self, count):
+		return [(i, {'from_': 'whatsapp:+10000000000', 'to': 'whatsapp:+1{:010d}'.format(i), 'body': 'Hi'})
+			for i in range(count)]
+
+	def test_dispatch_keeps_input_order(self):
+		with self.dispatcher_class(self.client, max_workers=8) as dispatcher:
+			results, stats = dispatcher.dispatch(self.get_messages(20))
+
+		self.assertEqual([r.key for r in results], list(range(20)))
+		self.assertEqual(stats.sent, 20)
+		self.assertEqual(len({r.response.sid for r in results}), 20)
+		self.assertGreater(stats.throughput, 0)
+
+	def test_dispatch_retries_throttled_requests(self):
+		self.server.throttle = 2
+		with self.dispatcher_class(self.client, max_workers=1, backoff=0) as dispatcher:
+			results, stats = dispatcher.dispatch(self.get_messages(3))
+
+		self.assertEqual(stats.sent, 3)
+		self.assertEqual(stats.throttled, 2)
+
+	def test_dispatch_gives_up_after_max_retries(self):
+		self.server.throttle = 10
+		with self.dispatcher_class(self.client, max_workers=1, max_retries=1, backoff=0) as dispatcher:
+			results, stats = dispatcher.dispatch(self.get_messages(1))
+
+		self.assertEqual(stats.failed, 1)
+		self.assertEqual(results[0].error.status, 429)
+
+	def test_dispatch_paced_by_rate_governor(self):
+		# The governor is used from the dispatcher's worker threads, which have no frappe.local
+		governor = RateGovernor(self.client.username, rate=100, max_rate=100)
+		self.addCleanup(governor.cache.delete, governor.get_key(), governor.get_key('whatsapp:+10000000000'))
+		self.server.throttle = 2
+		with self.dispatcher_class(self.client, max_workers=4, limiter=governor) as dispatcher:
+			results, stats = dispatcher.dispatch(self.get_messages(10))
+
+		self.assertEqual(stats.sent, 10)
+		self.assertEqual(stats.throttled, 2)
+		self.assertLess(governor.get_rates()['account'], 100)
+
+	def test_retryable_errors(self):
+		def error(status, code=None):
+			return TwilioRestException(status, 'uri', code=code)
+
+		self.assertTrue(is_retryable_error(error(429, 20429)))
+		self.assertTrue(is_retryable_error(error(503)))
+		self.assertTrue(is_retryable_error(ConnectionError()))
+		self.assertFalse(is_retryable_error(error(400, 21211)))
+		self.assertFalse(is_retryable_error(error(400, 63016)))
+		self.assertFalse(is_retryable_error(error(401, 20003)))
+
+@unittest.skipUnless(importlib.util.find_spec('httpx'), 'httpx is not installed')
+class TestAsyncWhatsAppDispatcher(TestWhatsAppDispatcher):
+	dispatcher_class = AsyncWhatsAppDispatcher
+
+	def test_dispatch_keeps_many_requests_in_flight(self):
+		with self.dispatcher_class(self.client, max_workers=200) as dispatcher:
+			results, stats = dispatcher.dispatch(self.get_messages(500))
+
+		self.assertEqual(stats.sent, 500)
+		self.assertEqual([r.key for r in results], list(range(500)))
@@ -0,0 +1,77 @@
+# Copyright (c) 2026, Frappe and Contributors
+# See license.txt
+
+import unittest
+from unittest.mock import patch
+
+import frappe
+from twilio_integration.twilio_integration.rate_limiter import RateGovernor, DECREASE_INTERVAL
+
+SENDER = 'whatsapp:+10000000000'
+
+
+class FakeClock:
+	"""Stands in for the `time` module of the governor, sleeping only moves the clock forward.
+	"""
+	def __init__(self):
+		self.now = 1_000_000.0
+		self.slept = 0
+
+	def time(self):
+		return self.now
+
+	def sleep(self, seconds):
+		# Like a real sleep, move on at least a little even when the bucket is a rounding error short of a token
+		seconds = max(seconds, 0.001)
+		self.now += seconds
+		self.slept += seconds
+
+
+class TestRateGovernor(unittest.TestCase):
+	def setUp(self):
+		self.clock = FakeClock()
+		patcher = patch('twilio_integration.twilio_integration.rate_limiter.time', self.clock)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+		self.governor = RateGovernor('AC' + frappe.generate_hash(length=32), rate=10, max_rate=20)
+		self.addCleanup(self.governor.cache.delete, self.governor.get_key(), self.governor.get_key(SENDER))
+
+	def test_acquire_waits_for_a_token(self):
+		# Buckets start full
+		for i in range(10):
+			self.governor.acquire(SENDER)
+		self.assertEqual(self.clock.slept, 0)
+
+		self.governor.acquire(SENDER)
+		self.assertGreater(self.clock.slept, 0)
+		self.assertLessEqual(self.clock.slept, 0.11)
+
+	def test_rate_increases_up_to_max_rate(self):
+		for i in range(500):
+			self.governor.acquire(SENDER)
+
+		rates = self.governor.get_rates([SENDER])
+		self.assertEqual(rates[SENDER], 20)
+		# The account has no configured limit
+		self.assertGreater(rates['account'], 20)
+
+	def test_account_throttle_blocks_for_retry_after(self):
+		self.governor.throttled(SENDER, frappe._dict(code=20429), retry_after=2)
+		self.assertEqual(self.governor.get_rates([SENDER]), {'account': 5, SENDER: 10})
+
+		self.governor.acquire(SENDER)
+		self.assertGreaterEqual(self.clock.slept, 2)
+
+	def test_sender_throttle_only_slows_the_sender(self):
+		self.governor.throttled(SENDER, frappe._dict(code=63018))
+		self.assertEqual(self.governor.get_rates([SENDER]), {'account': 10, SENDER: 5})
+
+	def test_concurrent_throttles_halve_the_rate_once(self):
+		self.governor.throttled(SENDER, frappe._dict(code=20429))
+		self.governor.throttled(SENDER, frappe._dict(code=20429))
+		self.assertEqual(self.governor.get_rates()['account'], 5)
+
+		self.clock.sleep(DECREASE_INTERVAL)
+		self.governor.throttled(SENDER, frappe._dict(code=20429))
+		self.assertEqual(self.governor.get_rates()['account'], 2.5)
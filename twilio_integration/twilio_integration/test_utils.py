@@ -0,0 +1,63 @@
+# Copyright (c) 2026, Frappe and Contributors
+# See license.txt
+
+import unittest
+
+import frappe
+from twilio_integration.twilio_integration.utils import is_first_delivery, forget_delivery, get_delivery_key, \
+	normalize_phone_number, dedupe_phone_numbers
+
+
+class TestWebhookDeliveries(unittest.TestCase):
+	def setUp(self):
+		self.message_sid = 'SM' + frappe.generate_hash(length=32)
+		self.addCleanup(frappe.cache().delete_value, get_delivery_key('whatsapp', self.message_sid))
+
+	def test_redelivery_is_recognised(self):
+		self.assertTrue(is_first_delivery('whatsapp', self.message_sid))
+		self.assertFalse(is_first_delivery('whatsapp', self.message_sid))
+
+	def test_kinds_are_separate(self):
+		self.addCleanup(frappe.cache().delete_value, get_delivery_key('call', self.message_sid))
+		self.assertTrue(is_first_delivery('whatsapp', self.message_sid))
+		self.assertTrue(is_first_delivery('call', self.message_sid))
+
+	def test_forgotten_delivery_is_let_through_again(self):
+		self.assertTrue(is_first_delivery('whatsapp', self.message_sid))
+		forget_delivery('whatsapp', self.message_sid)
+		self.assertTrue(is_first_delivery('whatsapp', self.message_sid))
+
+	def test_missing_key_is_always_first(self):
+		self.assertTrue(is_first_delivery('whatsapp', None))
+		self.assertTrue(is_first_delivery('whatsapp', None))
+
+
+class TestPhoneNumbers(unittest.TestCase):
+	def test_international_numbers(self):
+		self.assertEqual(normalize_phone_number('whatsapp:+1 (234) 567-8900'), '+12345678900')
+		self.assertEqual(normalize_phone_number('0044 20 7946 0958'), '+442079460958')
+		self.assertEqual(normalize_phone_number('+44 20 7946 0958', '+91'), '+442079460958')
+
+	def test_national_numbers_take_default_country_code(self):
+		self.assertEqual(normalize_phone_number('098765 43210', '+91'), '+919876543210')
+		self.assertEqual(normalize_phone_number('98765 43210', '91'), '+919876543210')
+		self.assertEqual(normalize_phone_number('(555) 123-4567', '+1'), '+15551234567')
+
+	def test_national_numbers_without_country_code_are_invalid(self):
+		self.assertIsNone(normalize_phone_number('(555) 123-4567'))
+		self.assertIsNone(normalize_phone_number('09876543210'))
+
+	def test_invalid_numbers(self):
+		self.assertIsNone(normalize_phone_number('+09876543210'))
+		self.assertIsNone(normalize_phone_number('+1 234'))
+		self.assertIsNone(normalize_phone_number('+1 234 567 8900 1234 5'))
+		self.assertIsNone(normalize_phone_number('abc', '+91'))
+
+	def test_dedupe_keeps_first_of_each_number(self):
+		receivers, skipped = dedupe_phone_numbers(['+91 98765 43210', '098765 43210', '(555) 123-4567', '+919876543210'], '+91')
+		self.assertEqual(receivers, [('+919876543210', '+91 98765 43210'), ('+915551234567', '(555) 123-4567')])
+		self.assertEqual(skipped, {'duplicates': 2, 'invalid': 0})
+
+		receivers, skipped = dedupe_phone_numbers(['(555) 123-4567', '+15551234567'])
+		self.assertEqual(receivers, [('+15551234567', '+15551234567')])
+		self.assertEqual(skipped, {'duplicates': 0, 'invalid': 1})
@@ -1,14 +1,39 @@
 import re
 import json
+import asyncio
+import time
+import random
+import threading
+from requests.adapters import HTTPAdapter
 from twilio.rest import Client as TwilioClient
+from twilio.rest.api.v2010.account.message import MessageInstance
+from twilio.base.exceptions import TwilioRestException
+from twilio.http.http_client import TwilioHttpClient
 from twilio.jwt.access_token import AccessToken
 from twilio.jwt.access_token.grants import VoiceGrant
 from twilio.twiml.voice_response import VoiceResponse, Dial
 
 import frappe
 from frappe import _
+from frappe.utils import cint, flt
 from frappe.utils.password import get_decrypted_password
-from .utils import get_public_url, merge_dicts
+from .utils import get_public_url, merge_dicts, filter_set_members
+from .call_routing import get_routing_strategy, set_dialled_attender
+from .twiml import get_twiml_template
+
+# Per worker cache of REST clients, site -> ((account_sid, settings version), client).
+# Each client holds a keep-alive session so that consecutive API calls reuse warm connections.
+_twilio_clients = {}
+_twilio_clients_lock = threading.Lock()
+HTTP_POOL_SIZE = 10
+HTTP_TIMEOUT = 30
+ASYNC_MAX_CONCURRENCY = 100
+
+NUMBER_OWNERS_CACHE = 'twilio_number_owners'
+VOICE_TOKEN_CACHE = 'twilio_voice_token::{}'
+VOICE_TOKEN_TTL = 60*60
+VOICE_TOKEN_REFRESH_MARGIN = 5*60 # seconds before expiry
+ONLINE_AGENTS = 'twilio_online_agents'
 
 class Twilio:
 	"""Twilio connector over TwilioClient.
@@ -21,24 +46,41 @@ class Twilio:
 		self.account_sid = settings.account_sid
 		self.application_sid = settings.twiml_sid
 		self.api_key = settings.api_key
-		self.api_secret = settings.get_password("api_secret")
-		self.twilio_client = self.get_twilio_client()
+
+	@property
+	def api_secret(self):
+		return self.settings.get_password("api_secret")
+
+	@property
+	def twilio_client(self):
+		"""REST client, only resolved by the calls that talk to the Twilio API.
+		"""
+		return self.get_twilio_client()
 
 	@classmethod
 	def connect(self):
 		"""Make a twilio connection.
 		"""
-		settings = frappe.get_doc("Twilio Settings")
+		settings = frappe.get_cached_doc("Twilio Settings")
 		if not (settings and settings.enabled):
 			return
 		return Twilio(settings=settings)
 
-	def get_phone_numbers(self):
-		"""Get account's twilio phone numbers.
+	def get_phone_numbers(self, capability=None):
+		"""Get account's twilio phone numbers, only those with `capability` (Voice, SMS or WhatsApp) if it is given.
 		"""
 		numbers = self.twilio_client.incoming_phone_numbers.list()
+		if capability == 'WhatsApp':
+			numbers = [n for n in numbers if n.phone_number == self.get_whatsapp_number()]
+		elif capability:
+			numbers = [n for n in numbers if (n.capabilities or {}).get(capability.lower())]
 		return [n.phone_number for n in numbers]
 
+	def get_whatsapp_number(self):
+		"""WhatsApp sender of the settings as a plain phone number.
+		"""
+		return (self.settings.whatsapp_no or '').replace('whatsapp:', '').strip()
+
 	def generate_voice_access_token(self, from_number: str, identity: str, ttl=60*60):
 		"""Generates a token required to make voice calls from the browser.
 		"""
@@ -74,9 +116,11 @@ class Twilio:
 		url_path = "/api/method/twilio_integration.twilio_integration.api.update_recording_info"
 		return get_public_url(url_path)
 
-	def generate_twilio_dial_response(self, from_number: str, to_number: str):
-		"""Generates voice call instructions to forward the call to agents Phone.
-		"""
+	def get_call_status_callback_url(self):
+		url_path = "/api/method/twilio_integration.twilio_integration.api.call_status_callback"
+		return get_public_url(url_path)
+
+	def build_dial_response(self, from_number: str, to_number: str):
 		resp = VoiceResponse()
 		dial = Dial(
 			caller_id=from_number,
@@ -84,16 +128,30 @@ class Twilio:
 			recording_status_callback=self.get_recording_status_callback_url(),
 			recording_status_callback_event='completed'
 		)
-		dial.number(to_number)
+		dial.number(to_number,
+			status_callback=self.get_call_status_callback_url(),
+			status_callback_event='completed'
+		)
 		resp.append(dial)
 		return resp
 
+	def generate_twilio_dial_response(self, from_number: str, to_number: str):
+		"""Generates voice call instructions to forward the call to agents Phone.
+		"""
+		if not from_number:
+			# Without a caller id Twilio presents the caller's own number, the attribute is left out
+			template = get_twiml_template('dial:no_caller_id', self.settings,
+				lambda to_number: self.build_dial_response(None, to_number), params=('to_number',))
+			return template.render(to_number=to_number)
+
+		template = get_twiml_template('dial', self.settings, self.build_dial_response,
+			params=('from_number', 'to_number'))
+		return template.render(from_number=from_number, to_number=to_number)
+
 	def get_call_info(self, call_sid):
 		return self.twilio_client.calls(call_sid).fetch()
 
-	def generate_twilio_client_response(self, client, ring_tone='at'):
-		"""Generates voice call instructions to forward the call to agents computer.
-		"""
+	def build_client_response(self, client, ring_tone='at'):
 		resp = VoiceResponse()
 		dial = Dial(
 			ring_tone=ring_tone,
@@ -101,20 +159,147 @@ class Twilio:
 			recording_status_callback=self.get_recording_status_callback_url(),
 			recording_status_callback_event='completed'
 		)
-		dial.client(client)
+		dial.client(client,
+			status_callback=self.get_call_status_callback_url(),
+			status_callback_event='completed'
+		)
 		resp.append(dial)
 		return resp
 
+	def generate_twilio_client_response(self, client, ring_tone='at'):
+		"""Generates voice call instructions to forward the call to agents computer.
+		"""
+		template = get_twiml_template('client:' + ring_tone, self.settings,
+			lambda client: self.build_client_response(client, ring_tone), params=('client',))
+		return template.render(client=client)
+
+	def generate_unavailable_response(self):
+		template = get_twiml_template('unavailable', self.settings, build_unavailable_response)
+		return template.render()
+
 	@classmethod
 	def get_twilio_client(self):
-		twilio_settings = frappe.get_doc("Twilio Settings")
+		"""Get the pooled REST client of this worker, building it on first use or after settings change.
+		"""
+		twilio_settings = frappe.get_cached_doc("Twilio Settings")
 		if not twilio_settings.enabled:
 			frappe.throw(_("Please enable twilio settings before sending WhatsApp messages"))
-		
-		auth_token = get_decrypted_password("Twilio Settings", "Twilio Settings", 'auth_token')
-		client = TwilioClient(twilio_settings.account_sid, auth_token)
 
-		return client
+		site = frappe.local.site
+		version = (twilio_settings.account_sid, str(twilio_settings.modified))
+		cached = _twilio_clients.get(site)
+		if cached and cached[0] == version:
+			return cached[1]
+
+		with _twilio_clients_lock:
+			cached = _twilio_clients.get(site)
+			if not (cached and cached[0] == version):
+				auth_token = get_decrypted_password("Twilio Settings", "Twilio Settings", 'auth_token')
+				pool_size = max(HTTP_POOL_SIZE, cint(twilio_settings.max_concurrent_requests))
+				client = TwilioClient(twilio_settings.account_sid, auth_token, http_client=get_pooled_http_client(pool_size))
+				# Replaces the client of the site's previous settings version, other sites keep theirs
+				cached = _twilio_clients[site] = (version, client)
+		return cached[1]
+
+class PooledHttpClient(TwilioHttpClient):
+	"""Keeps `last_response` per thread, so that threads sharing the client read the headers of their own requests.
+	"""
+	def __init__(self, *args, **kwargs):
+		self._local = threading.local()
+		super().__init__(*args, **kwargs)
+
+	@property
+	def last_response(self):
+		return getattr(self._local, 'last_response', None)
+
+	@last_response.setter
+	def last_response(self, response):
+		self._local.last_response = response
+
+def get_pooled_http_client(pool_size=HTTP_POOL_SIZE):
+	"""Twilio HTTP client backed by a keep-alive session with `pool_size` connections per host.
+	"""
+	http_client = PooledHttpClient(pool_connections=True, timeout=HTTP_TIMEOUT)
+	http_client.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+	return http_client
+
+class AsyncTwilioTransport:
+	"""Twilio REST calls over httpx on one event loop, with at most `max_concurrency` requests in flight.
+
+	httpx is optional, it is only imported when the transport is opened. Credentials come from the
+	synchronous `client`, and responses are returned as the same instances that client returns.
+	>>> async with AsyncTwilioTransport(client, max_concurrency=200) as transport:
+	...	message = await transport.create_message(to='whatsapp:+1..', from_='whatsapp:+1..', body='Hi')
+	"""
+	def __init__(self, client, max_concurrency=ASYNC_MAX_CONCURRENCY, timeout=HTTP_TIMEOUT, base_url=None):
+		self.client = client
+		self.max_concurrency = max_concurrency
+		self.timeout = timeout
+		self.base_url = base_url or client.api.base_url
+		self.session = None
+		self.semaphore = None
+
+	async def __aenter__(self):
+		import httpx
+
+		self.semaphore = asyncio.Semaphore(self.max_concurrency)
+		self.session = httpx.AsyncClient(
+			base_url=self.base_url,
+			auth=(self.client.username, self.client.password),
+			timeout=self.timeout,
+			limits=httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+		)
+		return self
+
+	async def __aexit__(self, *args):
+		await self.session.aclose()
+		self.session = None
+
+	async def request(self, method, uri, data=None, timeout=None):
+		async with self.semaphore:
+			response = await self.session.request(method, uri, data=data, timeout=timeout or self.timeout)
+
+		payload = response.json() if response.content else {}
+		if response.status_code >= 400:
+			error = TwilioRestException(response.status_code, self.base_url + uri,
+				msg=payload.get('message'), code=payload.get('code'), method=method)
+			error.retry_after = response.headers.get('Retry-After')
+			raise error
+		return payload
+
+	async def create_message(self, timeout=None, **params):
+		"""Async counterpart of `client.messages.create`, taking the same keyword arguments.
+		"""
+		account_sid = self.client.account_sid
+		payload = await self.request('POST', '/2010-04-01/Accounts/{}/Messages.json'.format(account_sid),
+			data=to_twilio_params(params), timeout=timeout)
+		return MessageInstance(self.client.api.v2010, payload, account_sid=account_sid)
+
+def get_retry_after(error, client=None):
+	"""Seconds a throttled request was asked to wait through the `Retry-After` header, 0 if it was not.
+	"""
+	retry_after = getattr(error, 'retry_after', None)
+	if retry_after is None and client:
+		response = getattr(client.http_client, 'last_response', None)
+		retry_after = response and response.headers and response.headers.get('Retry-After')
+	return flt(retry_after)
+
+def to_twilio_params(params):
+	"""Convert SDK style keyword arguments into Twilio request parameters.
+	>>> to_twilio_params({'from_': 'whatsapp:+1..', 'content_sid': 'HX..'})
+	{'From': 'whatsapp:+1..', 'ContentSid': 'HX..'}
+	"""
+	return {
+		''.join(part.title() for part in key.rstrip('_').split('_')): value
+		for key, value in params.items() if value is not None
+	}
+
+def clear_twilio_client_cache():
+	"""Drop the pooled REST client of this site in this worker.
+	Other workers pick up the new settings version on their next lookup.
+	"""
+	with _twilio_clients_lock:
+		_twilio_clients.pop(frappe.local.site, None)
 
 class IncomingCall:
 	def __init__(self, from_number, to_number, meta=None):
@@ -129,18 +314,22 @@ class IncomingCall:
 		"""
 		twilio = Twilio.connect()
 		owners = get_twilio_number_owners(self.to_number)
-		attender = get_the_call_attender(owners)
+		attender = get_the_call_attender(owners, self.to_number)
 
 		if not attender:
-			resp = VoiceResponse()
-			resp.say(_('Agent is unavailable to take the call, please call after some time.'))
-			return resp
+			return twilio.generate_unavailable_response()
 
 		if attender['call_receiving_device'] == 'Phone':
+			set_dialled_attender(attender['mobile_no'], attender['name'])
 			return twilio.generate_twilio_dial_response(self.from_number, attender['mobile_no'])
 		else:
 			return twilio.generate_twilio_client_response(twilio.safe_identity(attender['name']))
 
+def build_unavailable_response():
+	resp = VoiceResponse()
+	resp.say(_('Agent is unavailable to take the call, please call after some time.'))
+	return resp
+
 class TwilioCallDetails:
 	def __init__(self, call_info, call_from = None, call_to = None):
 		self.call_info = call_info
@@ -183,12 +372,17 @@ class TwilioCallDetails:
 
 def get_twilio_number_owners(phone_number):
 	"""Get list of users who is using the phone_number.
+	Served from a routing table in redis that is cleared when `Voice Call Settings` or users change.
 	>>> get_twilio_number_owners('+11234567890')
 	{
 		'owner1': {'name': '..', 'mobile_no': '..', 'call_receiving_device': '...'},
 		'owner2': {....}
 	}
 	"""
+	return frappe.cache().hget(NUMBER_OWNERS_CACHE, phone_number,
+		generator=lambda: load_twilio_number_owners(phone_number))
+
+def load_twilio_number_owners(phone_number):
 	user_voice_settings = frappe.get_all(
 		'Voice Call Settings',
 		filters={'twilio_number': phone_number},
@@ -205,23 +399,94 @@ def get_twilio_number_owners(phone_number):
 
 	return merge_dicts(user_wise_general_settings, user_wise_voice_settings)
 
+def clear_number_owners_cache(doc, method=None):
+	"""Drop the call routing table when routing relevant fields of a user or its voice settings change.
+	"""
+	if doc.doctype == 'User' and not doc.is_new() and method != 'on_trash' \
+		and not (doc.has_value_changed('mobile_no') or doc.has_value_changed('enabled')):
+		return
+	frappe.cache().delete_key(NUMBER_OWNERS_CACHE)
+
+
+def get_voice_access_token(user):
+	"""Signed voice token of the user, reused from redis until it gets close to its expiry.
+	Returns None when no Twilio number is mapped to the user.
+	>>> get_voice_access_token('agent@example.com')
+	{'token': '...', 'expires_in': 3300, 'refresh_in': 3080}
+	"""
+	settings = frappe.get_cached_doc("Twilio Settings")
+	cache = frappe.cache()
+	key = VOICE_TOKEN_CACHE.format(user)
+
+	cached = cache.get_value(key)
+	if not (cached and cached['version'] == str(settings.modified)):
+		from_number = frappe.db.get_value('Voice Call Settings', user, 'twilio_number')
+		if not from_number:
+			return
+
+		token = Twilio(settings).generate_voice_access_token(from_number=from_number, identity=user,
+			ttl=VOICE_TOKEN_TTL)
+		cached = {
+			'token': frappe.safe_decode(token),
+			'expires_at': time.time() + VOICE_TOKEN_TTL,
+			'version': str(settings.modified)
+		}
+		# Expire from redis before the earliest refresh, so refreshing clients always get a new token
+		cache.set_value(key, cached, expires_in_sec=VOICE_TOKEN_TTL - 2 * VOICE_TOKEN_REFRESH_MARGIN)
+
+	expires_in = int(cached['expires_at'] - time.time())
+	# Spread the refreshes of agents that logged in together over the margin
+	refresh_in = max(expires_in - VOICE_TOKEN_REFRESH_MARGIN - random.randint(0, VOICE_TOKEN_REFRESH_MARGIN), 0)
+	return {
+		'token': cached['token'],
+		'expires_in': expires_in,
+		'refresh_in': refresh_in
+	}
+
+def clear_voice_access_token(doc, method=None):
+	frappe.cache().delete_value(VOICE_TOKEN_CACHE.format(doc.name))
+
+
+def set_agent_online(login_manager):
+	frappe.cache().sadd(ONLINE_AGENTS, login_manager.user)
+
+def set_agent_offline(login_manager):
+	"""Take the user out of the online agents, unless another session of the user is still active.
+	"""
+	other_sessions = frappe.db.sql("""
+		SELECT COUNT(*) FROM `tabSessions`
+		WHERE `user` = %s AND `sid` != %s
+		""", (login_manager.user, frappe.session.sid))[0][0]
+	if not other_sessions:
+		frappe.cache().srem(ONLINE_AGENTS, login_manager.user)
+
+def sync_online_agents():
+	"""Rebuild the online agents from the sessions table, dropping sessions that expired without a logout.
+	"""
+	users = frappe.db.sql_list("SELECT DISTINCT `user` FROM `tabSessions`")
+	cache = frappe.cache()
+	key = cache.make_key(ONLINE_AGENTS)
+	pipeline = cache.pipeline()
+	pipeline.delete(key)
+	if users:
+		pipeline.sadd(key, *users)
+	pipeline.execute()
 
 def get_active_loggedin_users(users):
 	"""Filter the current loggedin users from the given users list
 	"""
-	rows = frappe.db.sql("""
-		SELECT `user`
-		FROM `tabSessions`
-		WHERE `user` IN %(users)s
-		""", {'users': users})
-	return [row[0] for row in set(rows)]
-
-def get_the_call_attender(owners):
-	"""Get attender details from list of owners
+	return filter_set_members(ONLINE_AGENTS, users)
+
+def get_the_call_attender(owners, phone_number=None):
+	"""Get attender details from list of owners.
+	The routing strategy of the Twilio number picks one of the owners that can take the call.
 	"""
 	if not owners: return
 	current_loggedin_users = get_active_loggedin_users(list(owners.keys()))
-	for name, details in owners.items():
+	available = [
+		details for name, details in sorted(owners.items())
 		if ((details['call_receiving_device'] == 'Phone' and details['mobile_no']) or
-			(details['call_receiving_device'] == 'Computer' and name in current_loggedin_users)):
-			return details
+			(details['call_receiving_device'] == 'Computer' and name in current_loggedin_users))
+	]
+	if available:
+		return get_routing_strategy(phone_number).route(available)
@@ -0,0 +1,66 @@
+"""TwiML responses rendered from skeletons compiled once per site, settings version and language.
+
+Building a `VoiceResponse` tree and serializing it on every webhook costs far more than the
+handful of values that actually change between calls. A skeleton is built once through the
+same tree builder with placeholders, and later responses only insert the escaped values.
+"""
+import frappe
+
+PLACEHOLDER = 'TWIMLPLACEHOLDER{}'
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>'
+
+# Per worker cache of compiled skeletons, (name, site, language) -> (settings version, skeleton)
+_twiml_templates = {}
+
+
+class TwiML:
+	"""Rendered response, serialized like twilio's `VoiceResponse`.
+	"""
+	def __init__(self, xml):
+		self.xml = xml
+
+	def to_xml(self, xml_declaration=True):
+		if xml_declaration:
+			return self.xml
+		return self.xml[len(XML_DECLARATION):]
+
+	def __str__(self):
+		return self.to_xml()
+
+
+class TwiMLTemplate:
+	def __init__(self, builder, params=()):
+		"""
+		:param builder: callable returning a `VoiceResponse`, called once with a placeholder for every param
+		:param params: names of the values inserted on render
+		"""
+		xml = builder(**{param: PLACEHOLDER.format(param) for param in params}).to_xml()
+		xml = xml.replace('{', '{{').replace('}', '}}')
+		for param in params:
+			xml = xml.replace(PLACEHOLDER.format(param), '{%s}' % param)
+		self.xml = xml
+
+	def render(self, **values):
+		return TwiML(self.xml.format(**{key: escape(value) for key, value in values.items()}))
+
+
+def escape(value):
+	"""Escape a value for both element text and double quoted attributes.
+	"""
+	return (str(value or '')
+		.replace('&', '&amp;')
+		.replace('<', '&lt;')
+		.replace('>', '&gt;')
+		.replace('"', '&quot;')
+		.replace('\n', '&#10;'))
+
+def get_twiml_template(name, settings, builder, params=()):
+	"""Compiled skeleton of the response `name`, rebuilt when `Twilio Settings` change.
+	The skeleton of the new settings version replaces the old one.
+	"""
+	key = (name, frappe.local.site, frappe.local.lang)
+	version = str(settings.modified)
+	cached = _twiml_templates.get(key)
+	if not cached or cached[0] != version:
+		cached = _twiml_templates[key] = (version, TwiMLTemplate(builder, params))
+	return cached[1]
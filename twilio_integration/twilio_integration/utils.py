@@ -1,6 +1,8 @@
+import re
+from functools import lru_cache
 from pyngrok import ngrok
 import frappe
-from frappe.utils import get_url
+from frappe.utils import get_url, now_datetime, cstr
 
 
 def get_public_url(path: str=None, use_ngrok: bool=False):
@@ -26,3 +28,183 @@ def merge_dicts(d1: dict, d2: dict):
 	... {'name1': {'age': 20, 'phone': '+xxx'}, 'name2': {'age': 30, 'phone': '+yyy'}}
 	"""
 	return {k:{**v, **d2.get(k, {})} for k, v in d1.items()}
+
+
+def bulk_update(doctype: str, updates: dict):
+	"""Update many rows of a doctype in one statement. Every row must update the same fields.
+	>>> bulk_update('WhatsApp Message', {
+		'name1': {'status': 'Queued', 'id': 'SM1'},
+		'name2': {'status': 'Error', 'id': None}
+	})
+	"""
+	if not updates:
+		return
+
+	names = list(updates)
+	fields = list(updates[names[0]])
+	set_clauses, values = [], []
+	for field in fields:
+		cases = ' '.join(['WHEN %s THEN %s'] * len(names))
+		set_clauses.append('`{0}` = CASE `name` {1} ELSE `{0}` END'.format(field, cases))
+		for name in names:
+			values.extend([name, updates[name].get(field)])
+
+	frappe.db.sql("""
+		UPDATE `tab{doctype}`
+		SET {set_clauses}, `modified` = %s
+		WHERE `name` IN ({names})
+		""".format(
+			doctype=doctype,
+			set_clauses=', '.join(set_clauses),
+			names=', '.join(['%s'] * len(names))
+		), values + [now_datetime()] + names)
+
+
+def push_to_buffer(name: str, payload: dict):
+	"""Append a payload to a redis list that is drained later by `read_buffer` and `trim_buffer`.
+	Returns the length of the buffer after the push.
+	"""
+	cache = frappe.cache()
+	# RedisWrapper.rpush does not return the length
+	return cache.pipeline(transaction=False).rpush(cache.make_key(name), frappe.as_json(payload, indent=None)).execute()[0]
+
+def read_buffer(name: str, size: int):
+	"""Oldest `size` payloads of the buffer, left in place until `trim_buffer` confirms them.
+	"""
+	return [frappe.parse_json(frappe.safe_decode(item)) for item in frappe.cache().lrange(name, 0, size - 1)]
+
+def trim_buffer(name: str, size: int):
+	frappe.cache().ltrim(name, size, -1)
+
+def get_buffer_length(name: str):
+	return frappe.cache().llen(name)
+
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+	return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+def acquire_lock(name: str, timeout: int):
+	"""Cross-worker lock that expires after `timeout` seconds.
+	Returns the token to release it with, None if it is already held.
+	"""
+	cache = frappe.cache()
+	token = frappe.generate_hash(length=20)
+	if cache.set(cache.make_key(name), token, nx=True, ex=timeout):
+		return token
+
+def release_lock(name: str, token: str):
+	"""Release a lock taken with `acquire_lock`, unless it expired and was taken by another worker since.
+	"""
+	cache = frappe.cache()
+	cache.register_script(RELEASE_LOCK_SCRIPT)(keys=[cache.make_key(name)], args=[token])
+
+def is_first_delivery(kind: str, key: str, ttl: int=24 * 60 * 60):
+	"""Whether this is the first delivery of a webhook for `key`, a MessageSid or CallSid, within `ttl` seconds.
+	Twilio redelivers webhooks that time out, repeats are recognised with a single SET NX
+	before any document work happens.
+	"""
+	if not key:
+		return True
+	cache = frappe.cache()
+	return bool(cache.set(cache.make_key(get_delivery_key(kind, key)), 1, nx=True, ex=ttl))
+
+def forget_delivery(kind: str, key: str):
+	"""Let a redelivery of `key` through again, for deliveries that failed to be processed.
+	"""
+	if key:
+		frappe.cache().delete_value(get_delivery_key(kind, key))
+
+def get_delivery_key(kind, key):
+	return 'twilio_delivery::{}::{}'.format(kind, key)
+
+
+@lru_cache(maxsize=100000)
+def normalize_phone_number(number: str, default_country_code: str=None):
+	"""Convert a phone number into E.164 format, returns None if it can not be one.
+	Numbers without an international prefix get the `default_country_code` in place of their trunk prefix 0,
+	without a default country code they are not valid.
+	>>> normalize_phone_number('whatsapp:+1 (234) 567-8900')
+	'+12345678900'
+	>>> normalize_phone_number('0044 20 7946 0958')
+	'+442079460958'
+	>>> normalize_phone_number('098765 43210', '+91')
+	'+919876543210'
+	>>> normalize_phone_number('(555) 123-4567') is None
+	True
+	"""
+	number = number.strip()
+	if number.startswith('whatsapp:'):
+		number = number[len('whatsapp:'):].strip()
+
+	digits = re.sub(r'\D', '', number)
+	if number.startswith('+'):
+		pass
+	elif digits.startswith('00'):
+		digits = digits[2:]
+	elif default_country_code:
+		digits = re.sub(r'\D', '', default_country_code) + re.sub(r'^0', '', digits)
+	else:
+		# A national number, its country is not known
+		return
+
+	# Country codes never start with 0
+	if digits.startswith('0') or not 8 <= len(digits) <= 15:
+		return
+	return '+' + digits
+
+def dedupe_phone_numbers(items: list, default_country_code: str=None, get_number=None):
+	"""Normalize phone numbers and keep the first item of every distinct number.
+	`get_number` picks the number of an item, items are the numbers themselves by default.
+	Returns a list of (normalized number, item) and the count of dropped duplicate and invalid numbers.
+	>>> dedupe_phone_numbers(['+1 234 567 8900', '0012345678900', '+12345678900', 'abc'])
+	([('+12345678900', '+1 234 567 8900')], {'duplicates': 2, 'invalid': 1})
+	"""
+	seen = set()
+	unique = []
+	invalid = 0
+	for item in items:
+		number = normalize_phone_number(cstr(get_number(item) if get_number else item), default_country_code)
+		if not number:
+			invalid += 1
+		elif number not in seen:
+			seen.add(number)
+			unique.append((number, item))
+
+	return unique, {'duplicates': len(items) - len(unique) - invalid, 'invalid': invalid}
+
+def get_set_membership(name: str, values: list):
+	"""Whether each value is a member of the redis set `name`, checked in one round trip.
+	"""
+	if not values:
+		return []
+
+	cache = frappe.cache()
+	key = cache.make_key(name)
+	pipeline = cache.pipeline(transaction=False)
+	for value in values:
+		pipeline.sismember(key, value)
+	return pipeline.execute()
+
+def filter_set_members(name: str, values: list):
+	"""Values that are members of the redis set `name`.
+	"""
+	return [value for value, is_member in zip(values, get_set_membership(name, values)) if is_member]
+
+def filter_new_set_members(name: str, values: list):
+	"""Values that are not members of the redis set `name` yet.
+	"""
+	return [value for value, is_member in zip(values, get_set_membership(name, values)) if not is_member]
+
+def add_set_members(name: str, values: list, expires_in: int):
+	if not values:
+		return
+
+	cache = frappe.cache()
+	key = cache.make_key(name)
+	pipeline = cache.pipeline()
+	pipeline.sadd(key, *values)
+	pipeline.expire(key, expires_in)
+	pipeline.execute()